@@ -0,0 +1,71 @@
+import json
+import time
+from typing import Optional, Dict
+
+from storage import SQLiteDatabase
+
+ANALYSIS_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    md5 TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    single_call INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL,
+    PRIMARY KEY (md5, prompt_hash, model, single_call)
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_cache_used_at ON analysis_cache(used_at);
+"""
+
+
+class AnalysisCache(SQLiteDatabase):
+    # VLM analysis results keyed by (image md5, prompt hash, model, single_call_mode).
+    # Entries expire after `ttl` seconds (0 keeps them forever); beyond `max_entries`
+    # the least recently used ones are evicted.
+    schema = ANALYSIS_CACHE_SCHEMA
+
+    def __init__(self, db_path: str = "cardgen.db", ttl: float = 0, max_entries: int = 10000):
+        super().__init__(db_path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, md5: str, prompts_hash: str, model: str, single_call: bool) -> Optional[Dict]:
+        key = (md5, prompts_hash, model, int(single_call))
+        row = self._conn().execute(
+            "SELECT result, created_at FROM analysis_cache WHERE md5 = ? AND prompt_hash = ? AND model = ? AND single_call = ?",
+            key,
+        ).fetchone()
+        if not row:
+            return None
+
+        now = time.time()
+        with self._tx() as conn:
+            if self.ttl and now - row[1] > self.ttl:
+                conn.execute(
+                    "DELETE FROM analysis_cache WHERE md5 = ? AND prompt_hash = ? AND model = ? AND single_call = ?",
+                    key,
+                )
+                return None
+            conn.execute(
+                "UPDATE analysis_cache SET used_at = ? WHERE md5 = ? AND prompt_hash = ? AND model = ? AND single_call = ?",
+                (now,) + key,
+            )
+        return json.loads(row[0])
+
+    def put(self, md5: str, prompts_hash: str, model: str, single_call: bool, result: Dict):
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache (md5, prompt_hash, model, single_call, result, created_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (md5, prompts_hash, model, int(single_call), json.dumps(result, ensure_ascii=False), now, now),
+            )
+            if self.ttl:
+                conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl,))
+            if self.max_entries:
+                conn.execute(
+                    "DELETE FROM analysis_cache WHERE rowid IN "
+                    "(SELECT rowid FROM analysis_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
@@ -1,33 +1,97 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, BackgroundTasks
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response, FileResponse
+from starlette.background import BackgroundTask
 from starlette.middleware.base import BaseHTTPMiddleware
-import shutil
+import asyncio
+import functools
+import io
 import os
 import uuid
 import hashlib
+import importlib
 import json
+import math
+import multiprocessing
 import random
-import requests
+import tempfile
+import threading
 import time
+import zipfile
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from typing import Optional, List, Dict
-from vlm import VLMService
+from vlm import VLMService, PromptSet, parse_endpoints, FIELDS
+from analysis_cache import AnalysisCache
+from storage import open_store, CachedJSONFile, SQLiteDatabase, SQLiteSettings, CARD_SORTS
+from blobs import open_blob_store
+from jobs import JobQueue, JobWorkerPool
+from events import EventBroker, EventLog
+from images import generate_thumbnails, dhash, format_phash
+from dedup import NearDuplicateIndex
+from prefetch import Prefetcher
+import metrics
+from metrics import span, timed, REGISTRY, CARDS_GENERATED, DEDUP_HITS, NEAR_DUP_HITS
+from warm_pool import PoolStore, WarmPool
+from static_assets import AssetVersions, CachedStaticFiles, precompress
+from render import FACES, RENDER_FORMATS, find_font, render_key, render_file
+
+# Startup and shutdown. Everything here runs once per worker, before it
+# accepts requests and after it stops; module import itself stays cheap.
+@asynccontextmanager
+async def lifespan(app):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    os.makedirs(CARD_BACKS_DIR, exist_ok=True)
+    open_databases()
+    pack_events.start()
+    start_pack_workers()
+    compress_static_assets()
+    start_warm_pool()
+    vlm_service.start()
+    if STARTUP_WARMUP:
+        warm_up()
+    try:
+        yield
+    finally:
+        stop_pack_workers()
+        stop_god_draw()
+        pack_events.stop()
+        vlm_service.close()
+        stop_render_pool()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Security Headers Middleware
 class SecurityHeadersMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request, call_next):
         response = await call_next(request)
         response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
+        # Static files, pages and ETag-validated routes set their own policy;
+        # everything else (the mutable /api JSON) is never stored.
+        if "cache-control" not in response.headers:
+            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+            response.headers["Pragma"] = "no-cache"
+            response.headers["Expires"] = "0"
         return response
 
 app.add_middleware(SecurityHeadersMiddleware)
 
+# Upload limits, enforced while ingesting and on the request Content-Length
+INGEST_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(1024 * 1024 * 1024)))
+
+# Reject oversized uploads from Content-Length before the body is parsed
+class RequestSizeLimitMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+            return JSONResponse(status_code=413, content={"detail": f"Request exceeds {MAX_REQUEST_BYTES} bytes"})
+        return await call_next(request)
+
+app.add_middleware(RequestSizeLimitMiddleware)
+
 # Allow CORS
 app.add_middleware(
     CORSMiddleware,
@@ -43,48 +107,167 @@ CARD_BACKS_DIR = "static/card_backs"
 CARDS_DB = "cards.json"
 PACKS_DB = "packs.json"
 SETTINGS_DB = "settings.json"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+SQLITE_DB = os.getenv("CARDGEN_DB", "cardgen.db")
+# Pre-open VLM connections and load the near-duplicate index before serving
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "false").lower() == "true"
+# "shared" runs several workers or hosts against one CARDGEN_DB: settings and
+# pack events go through the database too, so every worker sees them
+DEPLOYMENT_MODE = os.getenv("DEPLOYMENT_MODE", "single").lower()
+if DEPLOYMENT_MODE == "shared" and STORAGE_BACKEND != "sqlite":
+    raise ValueError("DEPLOYMENT_MODE=shared requires STORAGE_BACKEND=sqlite")
+
+# Uploaded images and thumbnails: "fs" keeps them under BLOB_DIR (a shared
+# mount when hosts do not share UPLOAD_DIR), "s3" in an S3-compatible bucket.
+# UPLOAD_DIR then works as each host's local copy.
+blobs = open_blob_store(
+    os.getenv("BLOB_STORE", "fs"),
+    root=os.getenv("BLOB_DIR", UPLOAD_DIR),
+    bucket=os.getenv("S3_BUCKET", ""),
+    prefix=os.getenv("S3_PREFIX", ""),
+    endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+    region=os.getenv("S3_REGION") or None
+)
 
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(CARD_BACKS_DIR, exist_ok=True)
-
-# Helper for Databases
-def load_cards():
-    if not os.path.exists(CARDS_DB):
-        return {}
-    with open(CARDS_DB, "r") as f:
-        return json.load(f)
-
-def save_cards(cards):
-    with open(CARDS_DB, "w") as f:
-        json.dump(cards, f, indent=2)
-
-def load_packs():
-    if not os.path.exists(PACKS_DB):
-        return {}
-    with open(PACKS_DB, "r") as f:
-        return json.load(f)
+# Card and pack storage (SQLite by default, STORAGE_BACKEND=json for the old files)
+store = open_store(STORAGE_BACKEND, db_path=SQLITE_DB, cards_path=CARDS_DB, packs_path=PACKS_DB)
+
+# Near-duplicate uploads (resized, re-compressed, ...) are matched by perceptual
+# hash within NEAR_DUP_THRESHOLD bits of 64. "flag" (the default) only records
+# the match, "off" skips it. "reuse" copies the matched card's analysis instead
+# of calling the VLM; it is opt-in, since merely similar images (plain or solid
+# ones all hash alike) would silently share a name and stats.
+NEAR_DUP_THRESHOLD = int(os.getenv("NEAR_DUP_THRESHOLD", "5"))
+NEAR_DUP_MODE = os.getenv("NEAR_DUP_MODE", "flag").lower()
+near_dup_index = NearDuplicateIndex(store)
+
+def compile_settings(settings):
+    return PromptSet(
+        settings.get("prompts", None),
+        settings.get("single_call_mode", False),
+        settings.get("single_call_prompt", "")
+    )
 
-def save_packs(packs):
-    with open(PACKS_DB, "w") as f:
-        json.dump(packs, f, indent=2)
+# Parsed settings and their prompts, rebuilt only when the settings change.
+# A shared deployment starts from settings.json once, then keeps them in the database.
+if DEPLOYMENT_MODE == "shared":
+    settings_cache = SQLiteSettings(SQLITE_DB, derive=compile_settings, import_path=SETTINGS_DB)
+else:
+    settings_cache = CachedJSONFile(SETTINGS_DB, derive=compile_settings)
 
 def load_settings():
-    if not os.path.exists(SETTINGS_DB):
-        return {}
-    with open(SETTINGS_DB, "r") as f:
-        return json.load(f)
-
-def save_settings(settings):
-    with open(SETTINGS_DB, "w") as f:
-        json.dump(settings, f, indent=2)
-
+    return settings_cache.get()
+
+def open_databases():
+    # Creates and migrates the tables at startup instead of on import, then
+    # moves the old cards.json / packs.json into the store once
+    for database in (store, settings_cache, analysis_cache, job_queue, pool_store, pack_events.log):
+        if isinstance(database, SQLiteDatabase):
+            database.open()
+    store.import_json(CARDS_DB, PACKS_DB)
+
+# Blocking work (file I/O, hashing, PIL, VLM requests) runs on this pool so the
+# event loop stays free for other clients.
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "16"))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+@timed("md5")
 def calculate_md5(file_path):
     hash_md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(INGEST_CHUNK_SIZE), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+@timed("upload")
+def ingest_upload(src, ext=""):
+    # Hash while copying to a temp file, so the copy is never read back for its
+    # md5. Returns (md5, temp_path). src is the UploadFile Starlette has already
+    # spooled while parsing the form (in memory up to 1 MB, then an anonymous temp
+    # file), so a large upload is still written and read once more there: this
+    # saves one pass of four, not half the I/O. Avoiding that would mean parsing
+    # the multipart body from request.stream() ourselves.
+    hash_md5 = hashlib.md5()
+    temp_path = os.path.join(UPLOAD_DIR, f"temp_{uuid.uuid4()}{ext}")
+    size = 0
+    try:
+        with open(temp_path, "wb") as buffer:
+            for chunk in iter(lambda: src.read(INGEST_CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES} bytes")
+                hash_md5.update(chunk)
+                buffer.write(chunk)
+    except BaseException:
+        discard_upload(temp_path)
+        raise
+    return hash_md5.hexdigest(), temp_path
+
+def lookup_card(file_md5, source):
+    # Dedup check: the card already generated from this image, if any
+    with span("dedup_lookup"):
+        card = store.get_card(file_md5)
+    if card:
+        DEDUP_HITS.inc(source=source)
+    return card
+
+def compute_phash(file_path):
+    try:
+        with span("phash"):
+            return format_phash(dhash(file_path))
+    except Exception as e:
+        print(f"Perceptual hash failed for {file_path}: {e}")
+        return None
+
+def find_near_duplicate(phash, file_md5):
+    # (card, distance) of the closest existing card from a similar image, if any
+    if not phash or NEAR_DUP_MODE == "off":
+        return None, None
+    with span("near_dup_lookup"):
+        match = near_dup_index.find(phash, NEAR_DUP_THRESHOLD, exclude=file_md5)
+        card = store.get_card(match[0]) if match else None
+    if not card:
+        return None, None
+    NEAR_DUP_HITS.inc(mode=NEAR_DUP_MODE)
+    return card, match[1]
+
+def discard_upload(temp_path):
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+def store_upload(temp_path, file_md5, ext):
+    # Moves an ingested file to its md5 name, returns the final path
+    final_path = os.path.join(UPLOAD_DIR, f"{file_md5}{ext or '.jpg'}")
+    if os.path.exists(final_path):
+        discard_upload(temp_path) # File exists (e.g. same content different name), just use existing
+    else:
+        os.rename(temp_path, final_path)
+        publish_upload(final_path)
+    return final_path
+
+def publish_upload(path):
+    # Copies a file from the upload directory to the blob store, for the other hosts
+    with span("blob_put"):
+        blobs.put(os.path.basename(path), path)
+
+def local_upload(filename):
+    # Path of an upload in this host's upload directory, fetched from the blob
+    # store when it is not there yet. The file may not exist at all.
+    path = os.path.join(UPLOAD_DIR, filename)
+    if not os.path.exists(path):
+        with span("blob_fetch"):
+            blobs.fetch(filename, path)
+    return path
+
+def fetch_upload(path):
+    # Missing /uploads files; only plain names, never subdirectories
+    if os.path.basename(path) == path:
+        local_upload(path)
+
 def get_available_card_backs():
     files = []
     if os.path.exists(CARD_BACKS_DIR):
@@ -97,11 +280,60 @@ def get_available_card_backs():
 API_BASE = os.getenv("VLM_API_BASE", "http://192.168.124.22:8080")
 API_KEY = os.getenv("VLM_API_KEY", "sk-placeholder")
 USE_STUB = os.getenv("USE_STUB", "true").lower() == "true"
+# Threads that analyze images: pack jobs, batch generation and god draws
+PACK_WORKERS = int(os.getenv("PACK_WORKERS", "4"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "10"))
+GOD_DRAW_WORKERS = int(os.getenv("GOD_DRAW_WORKERS", "10"))
+# VLM requests in flight from this process, over all of them. The default lets
+# every one of those threads run a full multi-field analysis at once.
+VLM_MAX_CONCURRENCY = int(os.getenv("VLM_MAX_CONCURRENCY", str(len(FIELDS) * (PACK_WORKERS + BATCH_WORKERS + GOD_DRAW_WORKERS))))
+VLM_IMAGE_CACHE_SIZE = int(os.getenv("VLM_IMAGE_CACHE_SIZE", "64"))
+VLM_POOL_SIZE = int(os.getenv("VLM_POOL_SIZE", "10"))
+VLM_CONNECT_TIMEOUT = float(os.getenv("VLM_CONNECT_TIMEOUT", "5"))
+VLM_READ_TIMEOUT = float(os.getenv("VLM_READ_TIMEOUT", "60"))
+VLM_MAX_RETRIES = int(os.getenv("VLM_MAX_RETRIES", "2"))
+VLM_BREAKER_THRESHOLD = int(os.getenv("VLM_BREAKER_THRESHOLD", "5"))
+VLM_BREAKER_RESET = float(os.getenv("VLM_BREAKER_RESET", "30"))
+# Comma-separated "url|weight" list; overrides VLM_API_BASE when set
+VLM_ENDPOINTS = parse_endpoints(os.getenv("VLM_ENDPOINTS", ""))
+VLM_HEALTH_CHECK_INTERVAL = float(os.getenv("VLM_HEALTH_CHECK_INTERVAL", "0"))
+# Analysis results are reused for the same image, prompts and model (TTL 0 never expires, 0 entries disables)
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", str(30 * 24 * 3600)))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "10000"))
+# Images per batched VLM request (1 disables batching) and how long a batch waits to fill
+VLM_BATCH_SIZE = int(os.getenv("VLM_BATCH_SIZE", "1"))
+VLM_BATCH_WAIT = float(os.getenv("VLM_BATCH_WAIT", "0.5"))
+
+analysis_cache = None
+if ANALYSIS_CACHE_MAX_ENTRIES > 0:
+    analysis_cache = AnalysisCache(SQLITE_DB, ttl=ANALYSIS_CACHE_TTL, max_entries=ANALYSIS_CACHE_MAX_ENTRIES)
+
+vlm_service = VLMService(
+    api_base=API_BASE,
+    api_key=API_KEY,
+    use_stub=USE_STUB,
+    max_concurrency=VLM_MAX_CONCURRENCY,
+    image_cache_size=VLM_IMAGE_CACHE_SIZE,
+    pool_size=VLM_POOL_SIZE,
+    connect_timeout=VLM_CONNECT_TIMEOUT,
+    read_timeout=VLM_READ_TIMEOUT,
+    max_retries=VLM_MAX_RETRIES,
+    breaker_threshold=VLM_BREAKER_THRESHOLD,
+    breaker_reset_timeout=VLM_BREAKER_RESET,
+    endpoints=VLM_ENDPOINTS,
+    health_check_interval=VLM_HEALTH_CHECK_INTERVAL,
+    result_cache=analysis_cache,
+    batch_size=VLM_BATCH_SIZE,
+    batch_wait=VLM_BATCH_WAIT
+)
 
-vlm_service = VLMService(api_base=API_BASE, api_key=API_KEY, use_stub=USE_STUB)
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Uploads and their thumbnails are named by content hash and never change.
+# /static is revalidated unless requested with the ?v= hash the pages use.
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+# The uploads directory is created at startup
+app.mount("/uploads", CachedStaticFiles(directory=UPLOAD_DIR, immutable=True, check_dir=False, fetch_missing=fetch_upload),
+          name="uploads")
+static_versions = AssetVersions("static")
 
 def get_random_effect_and_theme(rarity):
     rarity = rarity.upper()
@@ -147,20 +379,35 @@ def get_random_effect_and_theme(rarity):
 
     return effect, theme
 
-def process_single_file_generation(file_path, file_md5, card_back, existing_card=None, hidden=False):
-    # Load custom prompts
-    settings = load_settings()
-    custom_prompts = settings.get("prompts", None)
-    single_call_mode = settings.get("single_call_mode", False)
-    single_call_prompt = settings.get("single_call_prompt", "")
-
-    # Analyze
-    analysis = vlm_service.analyze_image(
-        file_path,
-        custom_prompts=custom_prompts,
-        single_call_mode=single_call_mode,
-        single_call_prompt=single_call_prompt
-    )
+@timed("thumbnails")
+def create_thumbnails(file_path, file_md5):
+    # Missing thumbnails only cost bandwidth, so never fail the card over them
+    try:
+        thumbnails = generate_thumbnails(file_path, file_md5, UPLOAD_DIR)
+        for urls in thumbnails.values():
+            for url in urls.values():
+                publish_upload(os.path.join(UPLOAD_DIR, os.path.basename(url)))
+        return thumbnails
+    except Exception as e:
+        print(f"Thumbnail generation failed for {file_path}: {e}")
+        return {}
+
+@timed("generate")
+def process_single_file_generation(file_path, file_md5, card_back, existing_card=None, hidden=False, reroll=False):
+    phash = compute_phash(file_path)
+    # Regenerating asks for a fresh analysis, so only new cards look for near-duplicates
+    duplicate, distance = (None, None) if existing_card or reroll else find_near_duplicate(phash, file_md5)
+
+    if duplicate and NEAR_DUP_MODE == "reuse":
+        analysis = {key: duplicate[key] for key in ("rarity", "name", "description", "atk", "def") if key in duplicate}
+    else:
+        # Analyze with the prompts of the current settings
+        analysis = vlm_service.analyze_image(
+            file_path,
+            image_md5=file_md5,
+            bypass_cache=reroll,
+            prompt_set=settings_cache.derived()
+        )
 
     filename = os.path.basename(file_path)
 
@@ -180,298 +427,481 @@ def process_single_file_generation(file_path, file_md5, card_back, existing_card
         "created_at": int(time.time()),
         "effect_type": effect,
         "color_theme": theme,
-        "hidden": hidden
+        "hidden": hidden,
+        "thumbnails": create_thumbnails(file_path, file_md5),
+        "phash": phash
     }
+    if duplicate:
+        new_card["near_duplicate_of"] = duplicate["md5"]
+        new_card["phash_distance"] = distance
+    if phash:
+        near_dup_index.add(file_md5, phash)
 
     # Preserve existing attributes if needed
     if existing_card:
         if not card_back and "card_back" in existing_card:
             new_card["card_back"] = existing_card["card_back"]
 
+    CARDS_GENERATED.inc()
     return new_card
 
-def background_pack_processing_wrapper(file_paths, pack_ids):
-    # This wrapper handles the file logic properly
-    chunk_size = 10
-    total_files = len(file_paths)
-
-    current_file_idx = 0
-
-    for pack_id in pack_ids:
-        pack_card_md5s = []
-
-        # Load pack to get assigned card back
-        packs = load_packs()
-        current_pack_back = None
-        if pack_id in packs:
-            current_pack_back = packs[pack_id].get("card_back")
-
-        # Process up to 10 files for this pack
-        files_in_pack = 0
-        while files_in_pack < 10 and current_file_idx < total_files:
-            temp_path = file_paths[current_file_idx]
-            current_file_idx += 1
-            files_in_pack += 1
-
-            try:
-                file_md5 = calculate_md5(temp_path)
-
-                cards = load_cards()
-                if file_md5 in cards:
-                    # Clean temp
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-                    pack_card_md5s.append(file_md5)
-                else:
-                    # Move to final
-                    ext = os.path.splitext(temp_path)[1]
-                    if not ext: ext = ".jpg"
-                    final_filename = f"{file_md5}{ext}"
-                    final_path = os.path.join(UPLOAD_DIR, final_filename)
-
-                    if os.path.exists(final_path):
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-                    else:
-                        os.rename(temp_path, final_path)
-
-                    # Generate
-                    new_card = process_single_file_generation(
-                        final_path,
-                        file_md5,
-                        current_pack_back,
-                        hidden=True
-                    )
-                    cards[file_md5] = new_card
-                    save_cards(cards)
-                    pack_card_md5s.append(file_md5)
-            except Exception as e:
-                print(f"Error processing file {temp_path}: {e}")
-
-        # Update Pack
-        packs = load_packs()
-        if pack_id in packs:
-            packs[pack_id]["status"] = "ready"
-            packs[pack_id]["cards"] = pack_card_md5s
-            save_packs(packs)
+def process_pack_job(job):
+    # Generates (or reuses) the card for one image of a pack, returns its md5
+    temp_path = job["file_path"]
+    file_md5 = job["file_md5"] or calculate_md5(temp_path)
+
+    if lookup_card(file_md5, "pack"):
+        # Clean temp (a retried job may already point at the final file)
+        if os.path.basename(temp_path).startswith("temp_"):
+            discard_upload(temp_path)
+        return file_md5
+
+    # Move to final (jobs queued by older versions still point at the temp file)
+    final_path = temp_path
+    if os.path.basename(temp_path).startswith("temp_"):
+        final_path = store_upload(temp_path, file_md5, os.path.splitext(temp_path)[1])
+        # A retry after this point starts from the final file
+        job_queue.update_file_path(job["id"], final_path)
+    else:
+        # Stored at upload time, possibly by another host
+        final_path = local_upload(os.path.basename(temp_path))
+
+    # Load pack to get assigned card back
+    pack = store.get_pack(job["pack_id"])
+    current_pack_back = pack.get("card_back") if pack else None
+
+    # Generate
+    new_card = process_single_file_generation(
+        final_path,
+        file_md5,
+        current_pack_back,
+        hidden=True
+    )
+    store.put_card(new_card)
+    return file_md5
+
+def finalize_pack(pack_id):
+    results = job_queue.pack_results(pack_id)
+    with store.atomic():
+        pack = store.get_pack(pack_id)
+        if not pack or pack["status"] != "processing":
+            return
+        pack["status"] = "ready"
+        pack["cards"] = results
+        store.put_pack(pack)
+    pack_events.publish("pack", pack)
+
+def publish_job_progress(job, result_md5):
+    pack_events.publish("card", {
+        "pack_id": job["pack_id"],
+        "md5": result_md5,
+        "progress": job_queue.pack_progress(job["pack_id"])
+    })
+
+# Push channel for pack progress (server-sent events)
+pack_events = EventBroker(log=EventLog(SQLITE_DB) if DEPLOYMENT_MODE == "shared" else None)
+SSE_KEEPALIVE_SECONDS = 15
+
+# Pack processing: durable per-image jobs worked by a thread pool
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "2.0"))
+# A worker that stops renewing its jobs for this long is presumed dead, and
+# other workers take the jobs over
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+job_queue = JobQueue(SQLITE_DB)
+job_pool = JobWorkerPool(
+    job_queue,
+    process_pack_job,
+    finalize_pack,
+    workers=PACK_WORKERS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    backoff_base=JOB_RETRY_BACKOFF,
+    on_job_done=publish_job_progress,
+    lease=JOB_LEASE_SECONDS
+)
+
+def start_pack_workers():
+    recovered = job_queue.recover()
+    if recovered:
+        print(f"Recovered {recovered} interrupted pack jobs")
+
+    # Packs whose jobs all finished before the pack itself was updated
+    unfinished = set(job_queue.unfinished_packs())
+    for pack in store.list_packs(exclude_status="opened"):
+        if pack["status"] == "processing" and pack["id"] not in unfinished:
+            finalize_pack(pack["id"])
+
+    job_pool.start()
+
+def compress_static_assets():
+    # A read-only static/ (container image, non-root user) only loses the
+    # precompressed variants; the plain files are still served
+    try:
+        written = precompress("static")
+    except OSError as e:
+        print(f"Skipping static asset precompression: {e}")
+        return
+    if written:
+        print(f"Precompressed {written} static assets")
+
+def stop_pack_workers():
+    job_pool.stop()
 
 @app.post("/api/generate")
 async def generate_card(
     file: Optional[UploadFile] = File(None),
     regenerate: bool = Form(False),
     existing_md5: Optional[str] = Form(None),
-    card_back: Optional[str] = Form(None)
+    card_back: Optional[str] = Form(None),
+    reroll: bool = Form(False)
 ):
+    return await run_blocking(generate_card_sync, file, regenerate, existing_md5, card_back, reroll)
+
+def generate_card_sync(file, regenerate, existing_md5, card_back, reroll=False):
     try:
-        cards = load_cards()
-        
         # Scenario 1: Re-generating an existing card by MD5 (no new file upload)
-        if existing_md5 and existing_md5 in cards and regenerate:
-            card_data = cards[existing_md5]
-            file_path = os.path.join(UPLOAD_DIR, card_data['filename'])
+        card_data = store.get_card(existing_md5) if existing_md5 and regenerate else None
+        if card_data:
+            file_path = local_upload(card_data['filename'])
             if not os.path.exists(file_path):
                 raise HTTPException(status_code=404, detail="Original image file missing")
             
-            new_card = process_single_file_generation(file_path, existing_md5, card_back, existing_card=card_data, hidden=False)
+            new_card = process_single_file_generation(file_path, existing_md5, card_back, existing_card=card_data, hidden=False, reroll=reroll)
             
-            cards[existing_md5] = new_card
-            save_cards(cards)
+            store.put_card(new_card)
             return JSONResponse(content=new_card, media_type="application/json; charset=utf-8")
 
         # Scenario 2: Uploading a file
         if not file:
              raise HTTPException(status_code=400, detail="File is required if not regenerating by MD5")
 
-        # Save temporarily to calculate MD5
-        temp_filename = f"temp_{uuid.uuid4()}"
-        temp_path = os.path.join(UPLOAD_DIR, temp_filename)
-        
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        file_md5 = calculate_md5(temp_path)
+        # Hash while saving
+        file_md5, temp_path = ingest_upload(file.file)
         
         # Check if exists
-        if file_md5 in cards and not regenerate:
+        with store.atomic():
+            existing = lookup_card(file_md5, "generate")
+            if existing and not regenerate and card_back:
+                # Update the binding if provided
+                existing["card_back"] = card_back
+                # Ensure it's visible if the user explicitly uploaded it again
+                existing["hidden"] = False
+                store.put_card(existing)
+        if existing and not regenerate:
             # Clean up temp file
-            os.remove(temp_path)
-            # Update the binding if provided
-            if card_back:
-                 cards[file_md5]["card_back"] = card_back
-                 # Ensure it's visible if the user explicitly uploaded it again
-                 cards[file_md5]["hidden"] = False
-                 save_cards(cards)
-
-            return JSONResponse(content=cards[file_md5], media_type="application/json; charset=utf-8")
+            discard_upload(temp_path)
+            return JSONResponse(content=existing, media_type="application/json; charset=utf-8")
             
         # If new or force regenerate with new file
-        file_extension = os.path.splitext(file.filename)[1]
-        if not file_extension:
-            file_extension = ".jpg"
-            
-        final_filename = f"{file_md5}{file_extension}"
-        final_path = os.path.join(UPLOAD_DIR, final_filename)
-        
-        # Rename temp to final
-        if os.path.exists(final_path):
-            os.remove(temp_path) # File exists (e.g. same content different name), just use existing
-        else:
-            os.rename(temp_path, final_path)
+        final_path = store_upload(temp_path, file_md5, os.path.splitext(file.filename)[1])
             
-        new_card = process_single_file_generation(final_path, file_md5, card_back, hidden=False)
+        new_card = process_single_file_generation(final_path, file_md5, card_back, hidden=False, reroll=reroll)
         
-        cards[file_md5] = new_card
-        save_cards(cards)
+        store.put_card(new_card)
         
         return JSONResponse(content=new_card, media_type="application/json; charset=utf-8")
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# Batch generation: at most BATCH_MAX_FILES images per request (larger sets
+# go through /api/upload-packs). New images are analyzed concurrently on a
+# shared pool, so VLM batching can group them and big batches queue up.
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "10"))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+
 @app.post("/api/batch-generate")
 async def batch_generate_card(
     files: List[UploadFile] = File(...),
-    card_back: Optional[str] = Form(None)
+    card_back: Optional[str] = Form(None),
+    stream: bool = Query(False)
 ):
+    # stream=true sends each card as a line of NDJSON as soon as it is ready:
+    # known images first, then new ones in the order they finish
+    if not stream:
+        return await run_blocking(batch_generate_sync, files, card_back)
+
+    # Uploads are read before the response starts, generation runs while it streams
+    results, new_files = await run_blocking(ingest_batch, files, card_back)
+    loop = asyncio.get_running_loop()
+    generations = {
+        file_md5: loop.run_in_executor(batch_executor, generate_batch_card, final_path, file_md5, card_back)
+        for final_path, file_md5 in new_files
+    }
+
+    # Every line about a new image names it: its md5 and the uploaded file name
+    filenames = {}
+    for file, result in zip(files, results):
+        if isinstance(result, str):
+            filenames.setdefault(result, []).append(file.filename)
+
+    async def generation(file_md5, future):
+        try:
+            return file_md5, await future, None
+        except Exception as e:
+            print(f"Batch generation failed for {file_md5}: {e}")
+            import traceback
+            traceback.print_exc()
+            return file_md5, None, str(e)
+
+    async def card_stream():
+        for result in results:
+            if not isinstance(result, str):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        # The same new image twice in one batch is sent twice
+        for next_card in asyncio.as_completed([generation(md5, future) for md5, future in generations.items()]):
+            file_md5, card, error = await next_card
+            for filename in filenames[file_md5]:
+                line = card if card else {"md5": file_md5, "filename": filename, "error": error}
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(card_stream(), media_type="application/x-ndjson; charset=utf-8")
+
+def ingest_batch(files, card_back):
+    # Saves every upload and resolves the ones that already have a card.
+    # Returns (results, new_files): results holds, in upload order, the known
+    # card or the md5 of a new image; new_files the (path, md5) to generate.
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {BATCH_MAX_FILES} images per batch, got {len(files)}. Use packs for larger sets."
+        )
+
+    # Save every upload before storing any, so a rejected file (too large, ...)
+    # leaves nothing of the batch behind
+    ingested = []
     try:
-        cards = load_cards()
-        generated_cards = []
+        for file in files:
+            # Hash while saving
+            ingested.append(ingest_upload(file.file))
+    except BaseException:
+        for _, temp_path in ingested:
+            discard_upload(temp_path)
+        raise
+
+    results = []
+    new_files = []
+    for file, (file_md5, temp_path) in zip(files, ingested):
+        # Check if exists (Skip regeneration for batch to save time/cost)
+        with store.atomic():
+            card = lookup_card(file_md5, "batch")
+            if card and card_back:
+                # Update card back binding for the batch
+                card["card_back"] = card_back
+                card["hidden"] = False # Unhide
+                store.put_card(card)
+        if card:
+            discard_upload(temp_path)
+            results.append(card)
+            continue
 
-        # Limit to 10 files
-        files_to_process = files
-        if len(files) > 10:
-            files_to_process = random.sample(files, 10)
+        # If new (the same image twice in one batch is generated once)
+        if file_md5 in results:
+            discard_upload(temp_path)
+            results.append(file_md5)
+            continue
+        final_path = store_upload(temp_path, file_md5, os.path.splitext(file.filename)[1])
+        new_files.append((final_path, file_md5))
+        results.append(file_md5) # Placeholder, keeps upload order
+    return results, new_files
 
-        for file in files_to_process:
-            # Save temporarily to calculate MD5
-            temp_filename = f"temp_{uuid.uuid4()}"
-            temp_path = os.path.join(UPLOAD_DIR, temp_filename)
+def generate_batch_card(final_path, file_md5, card_back):
+    card = process_single_file_generation(final_path, file_md5, card_back, hidden=False)
+    store.put_card(card)
+    return card
 
-            with open(temp_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+def batch_generate_sync(files, card_back):
+    try:
+        results, new_files = ingest_batch(files, card_back)
+        if new_files:
+            new_cards = list(batch_executor.map(lambda item: generate_batch_card(item[0], item[1], card_back), new_files))
+            by_md5 = {card["md5"]: card for card in new_cards}
+            results = [by_md5[card] if isinstance(card, str) else card for card in results]
 
-            file_md5 = calculate_md5(temp_path)
-
-            # Check if exists (Skip regeneration for batch to save time/cost)
-            if file_md5 in cards:
-                os.remove(temp_path)
-                card = cards[file_md5]
-                # Update card back binding for the batch
-                if card_back:
-                    card["card_back"] = card_back
-                    card["hidden"] = False # Unhide
-                    cards[file_md5] = card # Ensure update is saved
-                generated_cards.append(card)
-                continue
-
-            # If new
-            file_extension = os.path.splitext(file.filename)[1]
-            if not file_extension:
-                file_extension = ".jpg"
-
-            final_filename = f"{file_md5}{file_extension}"
-            final_path = os.path.join(UPLOAD_DIR, final_filename)
-
-            if os.path.exists(final_path):
-                os.remove(temp_path)
-            else:
-                os.rename(temp_path, final_path)
-
-            new_card = process_single_file_generation(final_path, file_md5, card_back, hidden=False)
-            cards[file_md5] = new_card
-            generated_cards.append(new_card)
-
-        save_cards(cards)
-        return JSONResponse(content=generated_cards, media_type="application/json; charset=utf-8")
+        return JSONResponse(content=results, media_type="application/json; charset=utf-8")
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# God draw: random images from GOD_DRAW_SOURCE_URL, which answers with either
+# JSON {"image_url": ...} or the image itself. Downloads run ahead of requests
+# into a bounded prefetch pool.
+GOD_DRAW_SOURCE_URL = os.getenv("GOD_DRAW_SOURCE_URL", "https://api.tcslw.cn/api/img/tbmjx?type=json")
+GOD_DRAW_PREFETCH = int(os.getenv("GOD_DRAW_PREFETCH", "10"))
+GOD_DRAW_FETCHERS = int(os.getenv("GOD_DRAW_FETCHERS", "4"))
+GOD_DRAW_TIMEOUT = float(os.getenv("GOD_DRAW_TIMEOUT", "30"))
+
+def fetch_random_image():
+    # Returns (md5, temp_path, ext) of a downloaded image, or None
+    import requests
+
+    resp = requests.get(GOD_DRAW_SOURCE_URL, timeout=10)
+    if resp.status_code != 200:
+        return None
+
+    image_url = GOD_DRAW_SOURCE_URL
+    if not resp.headers.get("content-type", "").startswith("image/"):
+        # The API returns one image at a time
+        image_url = resp.json().get("image_url")
+        if not image_url:
+            return None
+
+        # Download the image
+        resp = requests.get(image_url, timeout=10)
+        if resp.status_code != 200:
+            return None
+
+    # Try to guess extension from URL or default to .jpg
+    ext = os.path.splitext(image_url.split("?")[0])[1]
+    if not ext or len(ext) > 5:
+        ext = ".jpg"
+
+    # Hash while saving
+    file_md5, temp_path = ingest_upload(io.BytesIO(resp.content))
+    return file_md5, temp_path, ext
+
+god_draw_images = Prefetcher(
+    fetch_random_image,
+    lambda item: discard_upload(item[1]),
+    size=GOD_DRAW_PREFETCH,
+    workers=GOD_DRAW_FETCHERS
+)
+god_draw_executor = ThreadPoolExecutor(max_workers=GOD_DRAW_WORKERS, thread_name_prefix="god-draw")
+
+def generate_god_draw_card(card_back=None, hidden=False):
+    # A prefetched image turned into a card, or None when no image arrived
+    image = god_draw_images.take(timeout=GOD_DRAW_TIMEOUT)
+    if image is None:
+        return None
+    file_md5, temp_path, ext = image
+
+    # Check if exists
+    card = lookup_card(file_md5, "god_draw")
+    if card:
+        discard_upload(temp_path)
+        return card
+
+    # If new
+    final_path = store_upload(temp_path, file_md5, ext)
+
+    new_card = process_single_file_generation(final_path, file_md5, card_back, hidden=hidden)
+    store.put_card(new_card)
+    return new_card
+
+def refill_god_draw_pool():
+    card = generate_god_draw_card(hidden=True)
+    return card["md5"] if card else None
+
+# Hidden cards generated ahead of time, so a draw only has to reveal them
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "10"))
+WARM_POOL_WORKERS = int(os.getenv("WARM_POOL_WORKERS", "2"))
+WARM_POOL_INTERVAL = float(os.getenv("WARM_POOL_INTERVAL", "0"))
+
+pool_store = PoolStore(SQLITE_DB)
+god_draw_pool = WarmPool(
+    pool_store,
+    "god-draw",
+    refill_god_draw_pool,
+    target=WARM_POOL_SIZE,
+    workers=WARM_POOL_WORKERS,
+    interval=WARM_POOL_INTERVAL
+)
+
+def start_warm_pool():
+    # A pool that was used before keeps filling; otherwise the first draw starts it
+    if pool_store.depth(god_draw_pool.source):
+        god_draw_pool.start()
+
+def stop_god_draw():
+    # Pool workers take from the prefetcher, so they stop first
+    god_draw_pool.stop()
+    god_draw_images.stop()
+
+def warm_up():
+    # What the first requests would otherwise pay for: PIL, parsed settings,
+    # the near-duplicate index and connections to the VLM endpoints
+    started = time.perf_counter()
+    importlib.import_module("PIL.Image")
+    settings_cache.derived()
+    near_dup_index.load()
+    try:
+        vlm_service.warm_up()
+    except Exception as e:
+        print(f"VLM warm-up failed: {e}")
+    print(f"Warm-up took {time.perf_counter() - started:.2f}s")
+
+def draw_one_card(available_card_backs):
+    # One god draw: a card from the warm pool, or generated on the spot, or None
+    try:
+        # Pick a random card back
+        random_card_back = random.choice(available_card_backs) if available_card_backs else None
+
+        card = None
+        pooled_md5 = god_draw_pool.take()
+        if pooled_md5:
+            card = store.get_card(pooled_md5)
+        if card is None:
+            card = generate_god_draw_card(random_card_back)
+            if card is None:
+                return None
+
+        # Reveal, and update the binding so the random back persists
+        with store.atomic():
+            card = store.get_card(card["md5"]) or card
+            if card.get("hidden") or (random_card_back and card.get("card_back") != random_card_back):
+                if random_card_back:
+                    card["card_back"] = random_card_back
+                card["hidden"] = False
+                store.put_card(card)
+        return card
+
+    except Exception as loop_e:
+        print(f"Error in god draw: {loop_e}")
+        return None
+
 @app.post("/api/god-draw")
-async def god_draw_card():
+async def god_draw_card(stream: bool = Query(False)):
+    # stream=true sends each card as a line of NDJSON as soon as it is ready
+    if not stream:
+        return await run_blocking(god_draw_sync)
+
+    available_card_backs = await run_blocking(get_available_card_backs)
+    loop = asyncio.get_running_loop()
+    draws = [
+        loop.run_in_executor(god_draw_executor, draw_one_card, available_card_backs)
+        for _ in range(random.randint(5, 10))
+    ]
+
+    async def card_stream():
+        for next_card in asyncio.as_completed(draws):
+            card = await next_card
+            if card:
+                yield json.dumps(card, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(card_stream(), media_type="application/x-ndjson; charset=utf-8")
+
+def god_draw_sync():
     try:
-        cards = load_cards()
-        generated_cards = []
         available_card_backs = get_available_card_backs()
 
-        # Determine number of cards to draw (5-10)
+        # Determine number of cards to draw (5-10); the draws run in parallel
         num_draws = random.randint(5, 10)
+        cards = god_draw_executor.map(draw_one_card, [available_card_backs] * num_draws)
+        generated_cards = [card for card in cards if card]
 
-        for _ in range(num_draws):
-            # Fetch random image from API
-            try:
-                # The API returns one image at a time
-                resp = requests.get("https://api.tcslw.cn/api/img/tbmjx?type=json", timeout=10)
-                if resp.status_code != 200:
-                    continue
-                data = resp.json()
-                image_url = data.get("image_url")
-                if not image_url:
-                    continue
-
-                # Download the image
-                img_resp = requests.get(image_url, timeout=10)
-                if img_resp.status_code != 200:
-                    continue
-
-                image_content = img_resp.content
-
-                # Save temporarily to calculate MD5
-                temp_filename = f"temp_{uuid.uuid4()}"
-                temp_path = os.path.join(UPLOAD_DIR, temp_filename)
-
-                with open(temp_path, "wb") as f:
-                    f.write(image_content)
-
-                file_md5 = calculate_md5(temp_path)
-
-                # Pick a random card back
-                random_card_back = random.choice(available_card_backs) if available_card_backs else None
-
-                # Check if exists
-                if file_md5 in cards:
-                    os.remove(temp_path)
-                    card = cards[file_md5]
-                    # For god draw, maybe we force the random back for visual effect?
-                    # Or just use the existing one? The requirement says "randomly choose card back".
-                    # If we want to persist this random choice for this session, we can return it modified
-                    # without saving, OR update the binding. Updating binding is safer for persistence.
-                    if random_card_back:
-                        card["card_back"] = random_card_back
-                        card["hidden"] = False
-                        cards[file_md5] = card # Update binding
-                    generated_cards.append(card)
-                    continue
-
-                # If new
-                # Try to guess extension from URL or default to .jpg
-                ext = os.path.splitext(image_url)[1]
-                if not ext or len(ext) > 5:
-                    ext = ".jpg"
-
-                final_filename = f"{file_md5}{ext}"
-                final_path = os.path.join(UPLOAD_DIR, final_filename)
-
-                if os.path.exists(final_path):
-                    os.remove(temp_path)
-                else:
-                    os.rename(temp_path, final_path)
-
-                new_card = process_single_file_generation(final_path, file_md5, random_card_back, hidden=False)
-                cards[file_md5] = new_card
-                generated_cards.append(new_card)
-
-            except Exception as loop_e:
-                print(f"Error in god draw loop: {loop_e}")
-                continue
-
-        save_cards(cards)
         return JSONResponse(content=generated_cards, media_type="application/json; charset=utf-8")
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -479,23 +909,29 @@ async def god_draw_card():
 
 @app.post("/api/upload-packs")
 async def upload_packs(
-    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
     card_back: Optional[str] = Form(None) # Ignored now
 ):
+    return await run_blocking(upload_packs_sync, files)
+
+def upload_packs_sync(files):
     try:
-        packs = load_packs()
+        new_packs = []
         new_pack_ids = []
-        file_paths = []
+        ingested = []
         available_card_backs = get_available_card_backs()
 
-        # Save all files first
-        for file in files:
-            temp_filename = f"temp_pack_{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-            temp_path = os.path.join(UPLOAD_DIR, temp_filename)
-            with open(temp_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            file_paths.append(temp_path)
+        # Save all files first, hashing as they are written
+        try:
+            for file in files:
+                ingested.append(ingest_upload(file.file, os.path.splitext(file.filename)[1]))
+        except BaseException:
+            for _, temp_path in ingested:
+                discard_upload(temp_path)
+            raise
+        # Any worker, on any host, may pick up the jobs
+        stored = [(file_md5, store_upload(temp_path, file_md5, os.path.splitext(temp_path)[1]))
+                  for file_md5, temp_path in ingested]
 
         # Create Packs
         num_files = len(files)
@@ -508,22 +944,30 @@ async def upload_packs(
             # Randomly select card back for this pack
             random_back = random.choice(available_card_backs) if available_card_backs else None
 
-            packs[pack_id] = {
+            new_packs.append({
                 "id": pack_id,
                 "status": "processing",
                 "cards": [],
                 "created_at": int(time.time()),
                 "card_back": random_back
-            }
+            })
             new_pack_ids.append(pack_id)
 
-        save_packs(packs)
+        store.put_packs(new_packs)
+        for pack in new_packs:
+            pack_events.publish("pack", pack)
 
-        # Start Background Processing
-        background_tasks.add_task(background_pack_processing_wrapper, file_paths, new_pack_ids)
+        # Queue one job per image, 10 images per pack
+        job_queue.enqueue([
+            {"pack_id": new_pack_ids[i // 10], "position": i % 10, "file_path": file_path, "file_md5": file_md5}
+            for i, (file_md5, file_path) in enumerate(stored)
+        ])
+        job_pool.notify()
 
         return JSONResponse(content={"message": f"Processing {num_files} images into {num_packs} packs.", "pack_ids": new_pack_ids})
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -531,99 +975,313 @@ async def upload_packs(
 
 @app.get("/api/packs")
 async def get_packs():
-    packs = load_packs()
+    return await run_blocking(get_packs_sync)
 
-    pack_list = []
-    for pack in packs.values():
-        if pack["status"] != "opened":
-            pack_list.append(pack)
-
-    pack_list.sort(key=lambda x: x.get("created_at", 0), reverse=True)
+def get_packs_sync():
+    pack_list = store.list_packs(exclude_status="opened")
+    for pack in pack_list:
+        if pack["status"] == "processing":
+            pack["progress"] = job_queue.pack_progress(pack["id"])
     return JSONResponse(content=pack_list)
 
+@app.get("/api/packs/events")
+async def stream_pack_events(request: Request):
+    # "pack" events carry a pack whenever its status changes, "card" events
+    # report each finished image as {pack_id, md5, progress: {done, total}}
+    queue = pack_events.subscribe()
+
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            pack_events.unsubscribe(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/api/open-pack/{pack_id}")
 async def open_pack(pack_id: str):
-    packs = load_packs()
-    if pack_id not in packs:
-        raise HTTPException(status_code=404, detail="Pack not found")
+    return await run_blocking(open_pack_sync, pack_id)
 
-    pack = packs[pack_id]
-    if pack["status"] == "processing":
-        raise HTTPException(status_code=400, detail="Pack is still processing")
+def open_pack_sync(pack_id):
+    # Pack status and the cards it reveals change in one transaction
+    with store.atomic():
+        pack = store.get_pack(pack_id)
+        if not pack:
+            raise HTTPException(status_code=404, detail="Pack not found")
 
-    # Reveal cards
-    cards = load_cards()
-    revealed_cards = []
+        if pack["status"] == "processing":
+            raise HTTPException(status_code=400, detail="Pack is still processing")
 
-    for md5 in pack["cards"]:
-        if md5 in cards:
-            card = cards[md5]
-            card["hidden"] = False # Unhide!
-            cards[md5] = card
-            revealed_cards.append(card)
+        # Reveal cards
+        revealed_cards = []
 
-    pack["status"] = "opened"
-    packs[pack_id] = pack
+        for md5 in pack["cards"]:
+            card = store.get_card(md5)
+            if card:
+                card["hidden"] = False # Unhide!
+                revealed_cards.append(card)
 
-    save_cards(cards)
-    save_packs(packs)
+        pack["status"] = "opened"
+
+        store.put_cards(revealed_cards)
+        store.put_pack(pack)
+    pack_events.publish("pack", pack)
 
     return JSONResponse(content=revealed_cards)
 
 # Settings Endpoints
 @app.get("/api/settings")
 async def get_settings():
-    return JSONResponse(content=load_settings())
+    return await run_blocking(get_settings_sync)
 
-class SettingsModel(dict):
-    pass
+def get_settings_sync():
+    return JSONResponse(content=load_settings())
 
 @app.post("/api/settings")
 async def update_settings(settings: dict):
+    return await run_blocking(update_settings_sync, settings)
+
+def update_settings_sync(settings):
     # Validate structure?
     # Expected: { "prompts": { "rarity": "...", ... } }
-    current_settings = load_settings()
-    current_settings.update(settings)
-    save_settings(current_settings)
+    settings_cache.update(settings)
     return JSONResponse(content={"message": "Settings saved"})
 
+MAX_CARDS_PAGE = 500
+
+def is_not_modified(headers, etag, modified_at):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return math.ceil(modified_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 @app.get("/api/cards")
-async def get_cards():
-    cards = load_cards()
-    valid_cards = []
-    
-    for md5, card in cards.items():
-        # Check hidden status
-        if card.get("hidden", False):
-            continue
+async def get_cards(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_CARDS_PAGE),
+    cursor: Optional[str] = None,
+    rarity: Optional[str] = None,
+    q: Optional[str] = None,
+    sort: str = "date-desc"
+):
+    # Without `limit` this returns the full list as before; with it, a page
+    # of {"cards": [...], "next_cursor": ...}.
+    return await run_blocking(get_cards_sync, request, limit, cursor, rarity, q, sort)
+
+def get_cards_sync(request, limit, cursor, rarity, q, sort):
+    if sort not in CARD_SORTS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort: {sort}")
+
+    # Validators change with every card write, so unchanged libraries get a 304
+    version, modified_at = store.cards_version()
+    etag = '"' + hashlib.md5(f"{version}?{request.url.query}".encode()).hexdigest() + '"'
+    validators = {"ETag": etag, "Cache-Control": "no-cache"}
+    # Last-Modified has whole seconds: rounded up, and only sent once that second
+    # is over, so any later write moves it forward. Until then the ETag alone validates.
+    last_modified = math.ceil(modified_at)
+    if last_modified <= time.time():
+        validators["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if is_not_modified(request.headers, etag, modified_at):
+        return Response(status_code=304, headers=validators)
 
-        file_path = os.path.join(UPLOAD_DIR, card['filename'])
-        if os.path.exists(file_path):
-            valid_cards.append(card)
-            
-    return JSONResponse(content=valid_cards, media_type="application/json; charset=utf-8")
+    try:
+        cards, next_cursor = store.query_cards(
+            rarity=rarity.upper() if rarity else None,
+            search=q,
+            sort=sort,
+            limit=limit,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    content = {"cards": cards, "next_cursor": next_cursor} if limit else cards
+    return JSONResponse(content=content, headers=validators, media_type="application/json; charset=utf-8")
+
+# Server-side card images (render.py), cached under RENDER_CACHE_DIR by a hash
+# of the rendered card fields and the template version. Bulk exports render
+# on a process pool of RENDER_PROCESSES workers.
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "renders")
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", str(os.cpu_count() or 2)))
+RENDER_FONT = find_font(os.getenv("CARD_FONT"))
+render_pool = None
+render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    global render_pool
+    with render_pool_lock:
+        if render_pool is None:
+            # Forking a threaded server is unsafe; spawned workers only import render.py
+            render_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return render_pool
+
+def stop_render_pool():
+    if render_pool:
+        render_pool.shutdown(cancel_futures=True)
+
+def render_job(card, face, fmt, scale):
+    # Arguments for render.render_file, and the cache key of its output
+    backs = get_available_card_backs()
+    card = dict(card, card_back=card.get("card_back") or (backs[0] if backs else None))
+    key = render_key(card, face, fmt, scale)
+    back_path = os.path.join(CARD_BACKS_DIR, os.path.basename(card["card_back"])) if card["card_back"] else None
+    image_path = local_upload(card["filename"]) if face == "front" and card.get("filename") else None
+    dest = os.path.join(RENDER_CACHE_DIR, f"{key}.{fmt}")
+    return key, (card, image_path, back_path, dest, face, fmt, scale, RENDER_FONT)
+
+def check_render_options(face, fmt):
+    if face not in FACES:
+        raise HTTPException(status_code=400, detail=f"Unknown face: {face}")
+    if fmt not in RENDER_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {fmt}")
+
+@app.get("/api/cards/{md5}/render")
+async def render_card(
+    md5: str,
+    request: Request,
+    face: str = "front",
+    format: str = "png",
+    scale: int = Query(2, ge=1, le=4)
+):
+    return await run_blocking(render_card_sync, md5, request, face, format, scale)
+
+def render_card_sync(md5, request, face, fmt, scale):
+    check_render_options(face, fmt)
+    card = store.get_card(md5)
+    # Cards of unopened packs stay hidden here too
+    if not card or card.get("hidden"):
+        raise HTTPException(status_code=404, detail="Card not found")
+
+    key, args = render_job(card, face, fmt, scale)
+    headers = {"ETag": f'"{key}"', "Cache-Control": "no-cache"}
+    if is_not_modified(request.headers, headers["ETag"], None):
+        return Response(status_code=304, headers=headers)
+
+    os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+    with span("render"):
+        path = render_file(*args)
+    return FileResponse(path, media_type=f"image/{fmt}", headers=headers,
+                        filename=f"card-{md5}-{face}.{fmt}", content_disposition_type="inline")
+
+@app.get("/api/export")
+async def export_cards(
+    pack_id: Optional[str] = None,
+    face: str = "front",
+    format: str = "png",
+    scale: int = Query(2, ge=1, le=4)
+):
+    # A ZIP of one opened pack, or of the whole visible library without pack_id.
+    # face=both puts front and back of every card in it.
+    return await run_blocking(export_cards_sync, pack_id, face, format, scale)
+
+def export_cards_sync(pack_id, face, fmt, scale):
+    faces = FACES if face == "both" else (face,)
+    for f in faces:
+        check_render_options(f, fmt)
+
+    if pack_id:
+        pack = store.get_pack(pack_id)
+        if not pack:
+            raise HTTPException(status_code=404, detail="Pack not found")
+        if pack["status"] != "opened":
+            raise HTTPException(status_code=400, detail="Pack is not opened yet")
+        cards = [card for card in (store.get_card(md5) for md5 in pack["cards"]) if card]
+        name = f"pack-{pack_id}"
+    else:
+        cards = store.list_cards()
+        name = "cards"
+    if not cards:
+        raise HTTPException(status_code=404, detail="No cards to export")
+
+    os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+    entries = []
+    with span("export_render"):
+        pool = get_render_pool()
+        futures = []
+        for card in cards:
+            for f in faces:
+                _, args = render_job(card, f, fmt, scale)
+                futures.append(pool.submit(render_file, *args))
+                entries.append(f"{card['md5']}-{f}.{fmt}")
+        paths = [future.result() for future in futures]
+
+    # PNG and WebP are already compressed, so the archive only stores them
+    with span("export_zip"):
+        fd, zip_path = tempfile.mkstemp(suffix=".zip")
+        with os.fdopen(fd, "wb") as out, zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as archive:
+            for entry, path in zip(entries, paths):
+                archive.write(path, entry)
+    return FileResponse(zip_path, media_type="application/zip", filename=f"{name}.zip",
+                        background=BackgroundTask(os.remove, zip_path))
 
 @app.get("/api/card-backs")
 async def list_card_backs():
     files = get_available_card_backs()
     return JSONResponse(content={"card_backs": files}, media_type="application/json; charset=utf-8")
 
+@app.get("/api/pool")
+async def get_pool_stats():
+    stats = await run_blocking(god_draw_pool.stats)
+    return JSONResponse(content={"pools": [stats]}, media_type="application/json; charset=utf-8")
+
+@app.get("/api/vlm/endpoints")
+async def list_vlm_endpoints():
+    return JSONResponse(content={"endpoints": vlm_service.endpoint_stats()}, media_type="application/json; charset=utf-8")
+
+# Metrics read at scrape time
+METRICS_TRACE = os.getenv("METRICS_TRACE", "false").lower() == "true"
+metrics.trace_spans = METRICS_TRACE
+
+REGISTRY.gauge("cardgen_pack_queue_depth", "Pack jobs queued or running", job_queue.depth)
+REGISTRY.gauge("cardgen_warm_pool_depth", "Ready cards in the warm pool",
+               lambda: {(god_draw_pool.source,): pool_store.depth(god_draw_pool.source)}, ["source"])
+REGISTRY.gauge("cardgen_god_draw_prefetched", "Downloaded god draw images ready to use", god_draw_images.ready)
+REGISTRY.gauge("cardgen_sse_subscribers", "Connected pack event streams", pack_events.subscriber_count)
+REGISTRY.gauge("cardgen_vlm_endpoint_in_flight", "Outstanding requests per VLM endpoint",
+               lambda: {(e["url"],): e["outstanding"] for e in vlm_service.endpoint_stats()}, ["endpoint"])
+REGISTRY.gauge("cardgen_vlm_endpoint_up", "1 if a VLM endpoint is healthy and its circuit is not open",
+               lambda: {(e["url"],): int(e["healthy"] and e["circuit"] != "open") for e in vlm_service.endpoint_stats()}, ["endpoint"])
+REGISTRY.gauge("cardgen_vlm_endpoint_requests", "Requests sent to each VLM endpoint since start",
+               lambda: {(e["url"],): e["requests"] for e in vlm_service.endpoint_stats()}, ["endpoint"])
+
+@app.get("/metrics")
+async def get_metrics():
+    body = await run_blocking(REGISTRY.render)
+    return Response(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def page_response(page_path):
+    # Pages reference versioned assets, so the page itself must revalidate
+    return HTMLResponse(static_versions.render_html(page_path), headers={"Cache-Control": "no-cache"})
+
 @app.get("/")
 async def read_index():
-    return FileResponse('static/index.html')
+    return page_response('static/index.html')
 
 @app.get("/batch")
 async def read_batch():
-    return FileResponse('static/batch.html')
+    return page_response('static/batch.html')
 
 @app.get("/god-draw")
 async def read_god_draw():
-    return FileResponse('static/god_draw.html')
+    return page_response('static/god_draw.html')
 
 @app.get("/packs")
 async def read_packs():
-    return FileResponse('static/packs.html')
+    return page_response('static/packs.html')
 
 @app.get("/settings")
 async def read_settings():
-    return FileResponse('static/settings.html')
+    return page_response('static/settings.html')
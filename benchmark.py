@@ -0,0 +1,539 @@
+# Benchmark for the card generation pipeline.
+#
+# Runs the app in-process against a local fake OpenAI-compatible VLM server and
+# drives /api/generate, /api/batch-generate (also streamed), /api/upload-packs
+# and /api/cards.
+# The startup scenario times `import app` and uvicorn's time to first request
+# in fresh interpreters.
+# Results are JSON, so runs of different versions can be compared:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeVLMServer:
+    # OpenAI-compatible chat completions with latency + uniform jitter (seconds).
+    # Answers in whatever shape the prompt asks for: a JSON array for batches,
+    # a JSON object for single-call mode, plain text for per-field prompts.
+    def __init__(self, latency: float = 0.5, jitter: float = 0.1, port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.images = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-vlm", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._send({"data": [{"id": "fake-vlm"}]})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                content = payload["messages"][0]["content"]
+                images = sum(1 for part in content if part["type"] == "image_url")
+                prompt = next(part["text"] for part in content if part["type"] == "text")
+                with fake._lock:
+                    fake.requests += 1
+                    fake.images += images
+
+                time.sleep(max(0.0, fake.latency + random.uniform(-fake.jitter, fake.jitter)))
+                self._send({"choices": [{"message": {"content": fake.answer(prompt, images)}}]})
+
+            def _send(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    @staticmethod
+    def answer(prompt, images):
+        card = {"rarity": random.choice(["N", "R", "SR", "SSR", "UR"]), "name": "Benchmark Beast",
+                "description": "Draws one card.", "atk": random.randint(0, 5000), "def": random.randint(0, 5000)}
+        if "JSON array" in prompt:
+            return json.dumps([dict(card, index=i + 1) for i in range(images)])
+        if "JSON object" in prompt:
+            return json.dumps(card)
+        if "rarity" in prompt.lower():
+            return card["rarity"]
+        if "ATK" in prompt or "DEF" in prompt:
+            return str(card["atk"])
+        return card["name"]
+
+
+class StageTimer:
+    # Thread CPU time and wall time spent inside wrapped functions, per stage
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    def wrap(self, stage, func):
+        def wrapper(*args, **kwargs):
+            # Only the outermost wrapped call of a thread counts, so stages never overlap
+            if getattr(self._local, "active", False):
+                return func(*args, **kwargs)
+            self._local.active = True
+            cpu, wall = time.thread_time(), time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.active = False
+                self.add(stage, time.thread_time() - cpu, time.perf_counter() - wall)
+        return wrapper
+
+    def add(self, stage, cpu, wall):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"calls": 0, "cpu_s": 0.0, "wall_s": 0.0})
+            entry["calls"] += 1
+            entry["cpu_s"] += cpu
+            entry["wall_s"] += wall
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {"calls": entry["calls"], "cpu_s": round(entry["cpu_s"], 4), "wall_s": round(entry["wall_s"], 4)}
+                    for stage, entry in self.stages.items()}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    # Nearest rank
+    index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def latency_summary(latencies):
+    ms = [value * 1000 for value in latencies]
+    return {
+        "p50": round(percentile(ms, 50), 1) if ms else None,
+        "p95": round(percentile(ms, 95), 1) if ms else None,
+        "p99": round(percentile(ms, 99), 1) if ms else None,
+        "mean": round(sum(ms) / len(ms), 1) if ms else None,
+        "max": round(max(ms), 1) if ms else None,
+    }
+
+
+IMPORT_PROBE = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+
+
+def make_image(size):
+    # Noise compresses badly, so the upload and the PIL work are realistic
+    width, height = size
+    img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.timer = StageTimer()
+        self.base_url = None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, args.concurrency))
+        self.session.mount("http://", adapter)
+        # A few distinct images reused with a fresh trailer, so every upload has a new md5
+        self._images = [make_image(args.image_size) for _ in range(4)]
+        self._counter = 0
+        self._counter_lock = threading.Lock()
+
+    def unique_image(self):
+        with self._counter_lock:
+            self._counter += 1
+            n = self._counter
+        # Bytes after the JPEG end marker change the md5 but not the decoded image
+        return self._images[n % len(self._images)] + f"bench-{n}-{time.time_ns()}".encode()
+
+    def start_app(self, vlm_url):
+        os.environ.update({
+            "USE_STUB": "false",
+            "VLM_API_BASE": vlm_url,
+            "CARDGEN_DB": "bench.db",
+            "ANALYSIS_CACHE_MAX_ENTRIES": "0",
+            "WARM_POOL_SIZE": "0",
+            "NEAR_DUP_MODE": "off",
+        })
+        for name, value in self.args.env:
+            os.environ[name] = value
+
+        sys.path.insert(0, REPO_DIR)
+        import uvicorn
+        import app
+        import images
+
+        # Stages: PIL work (VLM payload encoding + thumbnails), HTTP to the VLM, persistence
+        service = app.vlm_service
+        service._encode_image = self.timer.wrap("pil_encode", service._encode_image)
+        app.generate_thumbnails = self.timer.wrap("pil_thumbnails", images.generate_thumbnails)
+        service._post_with_retries = self.timer.wrap("vlm_http", service._post_with_retries)
+        for method in ("put_card", "put_cards", "put_pack", "put_packs", "query_cards", "get_card"):
+            setattr(app.store, method, self.timer.wrap("persistence", getattr(app.store, method)))
+        for method in ("enqueue", "claim", "complete"):
+            setattr(app.job_queue, method, self.timer.wrap("persistence", getattr(app.job_queue, method)))
+
+        config = uvicorn.Config(app.app, host="127.0.0.1", port=self.args.port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        threading.Thread(target=self.server.run, name="uvicorn", daemon=True).start()
+        while not self.server.started:
+            time.sleep(0.05)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.app = app
+
+    def stop_app(self):
+        if getattr(self, "server", None):
+            self.server.should_exit = True
+
+    def drive(self, requests_count, call):
+        # Runs call() requests_count times at the configured concurrency
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def one(_):
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                ok = call()
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(one, range(requests_count)))
+        return latencies, errors, time.perf_counter() - started
+
+    def scenario(self, name, run):
+        print(f"Running {name}...", file=sys.stderr)
+        self.timer.reset()
+        cpu = time.process_time()
+        result = run()
+        result["process_cpu_s"] = round(time.process_time() - cpu, 3)
+        result["stages"] = self.timer.snapshot()
+        return result
+
+    def run_generate(self):
+        count = self.args.requests
+
+        def call():
+            files = {"file": ("bench.jpg", self.unique_image(), "image/jpeg")}
+            return self.session.post(f"{self.base_url}/api/generate", files=files).ok
+
+        latencies, errors, wall = self.drive(count, call)
+        return self.result(latencies, errors, wall, cards=len(latencies))
+
+    def run_batch(self):
+        size = self.args.batch_size
+
+        def call():
+            files = [("files", (f"bench{i}.jpg", self.unique_image(), "image/jpeg")) for i in range(size)]
+            return self.session.post(f"{self.base_url}/api/batch-generate", files=files).ok
+
+        latencies, errors, wall = self.drive(self.args.requests, call)
+        return self.result(latencies, errors, wall, cards=len(latencies) * size)
+
+    def run_batch_stream(self):
+        # Like batch, with ?stream=true; also reports when the first card arrived
+        size = self.args.batch_size
+        first_cards = []
+        lock = threading.Lock()
+
+        def call():
+            files = [("files", (f"bench{i}.jpg", self.unique_image(), "image/jpeg")) for i in range(size)]
+            started = time.perf_counter()
+            lines = 0
+            with self.session.post(f"{self.base_url}/api/batch-generate", params={"stream": "true"},
+                                   files=files, stream=True) as response:
+                if not response.ok:
+                    return False
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    if lines == 0:
+                        with lock:
+                            first_cards.append(time.perf_counter() - started)
+                    lines += 1
+            return lines == size
+
+        latencies, errors, wall = self.drive(self.args.requests, call)
+        result = self.result(latencies, errors, wall, cards=len(latencies) * size)
+        result["first_card_ms"] = latency_summary(first_cards)
+        return result
+
+    def run_packs(self):
+        # Latency is the upload request; throughput runs until every pack is ready
+        count = self.args.pack_images
+        files = [("files", (f"pack{i}.jpg", self.unique_image(), "image/jpeg")) for i in range(count)]
+        started = time.perf_counter()
+        response = self.session.post(f"{self.base_url}/api/upload-packs", files=files)
+        upload_latency = time.perf_counter() - started
+        if not response.ok:
+            return self.result([], 1, upload_latency, cards=0)
+
+        pack_ids = set(response.json()["pack_ids"])
+        while True:
+            packs = self.session.get(f"{self.base_url}/api/packs").json()
+            if all(pack["status"] != "processing" for pack in packs if pack["id"] in pack_ids):
+                break
+            time.sleep(0.1)
+        wall = time.perf_counter() - started
+        result = self.result([upload_latency], 0, wall, cards=count)
+        result["packs"] = len(pack_ids)
+        return result
+
+    def run_cards(self):
+        # Seeds the library directly, then pages through it and fetches the full list
+        existing = len(self.app.store.list_cards())
+        missing = max(0, self.args.library_size - existing)
+        now = int(time.time())
+        self.app.store.put_cards([
+            {"md5": f"bench{i:08d}", "filename": "bench.jpg", "image_url": "/uploads/bench.jpg",
+             "rarity": random.choice(["N", "R", "SR", "SSR", "UR"]), "name": f"Bench Card {i}",
+             "description": "Seeded by benchmark.py", "atk": "1000", "def": "1000",
+             "created_at": now - i, "hidden": False}
+            for i in range(missing)
+        ])
+        self.timer.reset()
+
+        def page():
+            return self.session.get(f"{self.base_url}/api/cards", params={"limit": 60, "sort": "rarity-desc"}).ok
+
+        def full():
+            return self.session.get(f"{self.base_url}/api/cards").ok
+
+        page_latencies, page_errors, page_wall = self.drive(self.args.requests * 5, page)
+        full_latencies, full_errors, full_wall = self.drive(self.args.requests, full)
+        return {
+            "library_size": max(existing, self.args.library_size),
+            "page": self.result(page_latencies, page_errors, page_wall),
+            "full_list": self.result(full_latencies, full_errors, full_wall),
+        }
+
+    def run_startup(self):
+        # Separate data directory, so the fresh workers leave the running app alone
+        workdir = os.path.abspath("startup")
+        os.makedirs(workdir, exist_ok=True)
+        if not os.path.exists(os.path.join(workdir, "static")):
+            os.symlink(os.path.abspath("static"), os.path.join(workdir, "static"))
+        env = dict(os.environ, PYTHONPATH=REPO_DIR)
+
+        imports, first_requests = [], []
+        import_errors = request_errors = 0
+        for _ in range(self.args.startup_runs):
+            probe = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=workdir, env=env,
+                                   capture_output=True, text=True)
+            if probe.returncode == 0:
+                imports.append(float(probe.stdout.split()[-1]))
+            else:
+                import_errors += 1
+            elapsed = self.time_to_first_request(workdir, env)
+            if elapsed is None:
+                request_errors += 1
+            else:
+                first_requests.append(elapsed)
+        return {
+            "import": {"runs": len(imports), "errors": import_errors, "latency_ms": latency_summary(imports)},
+            "first_request": {"runs": len(first_requests), "errors": request_errors,
+                              "latency_ms": latency_summary(first_requests)},
+        }
+
+    @staticmethod
+    def time_to_first_request(workdir, env, deadline=60.0):
+        # Seconds from spawning uvicorn until /api/cards answers, None if it never does
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        started = time.perf_counter()
+        worker = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - started < deadline and worker.poll() is None:
+                try:
+                    if requests.get(f"http://127.0.0.1:{port}/api/cards", params={"limit": 1}, timeout=5).ok:
+                        return time.perf_counter() - started
+                except requests.ConnectionError:
+                    pass
+                time.sleep(0.01)
+            return None
+        finally:
+            worker.terminate()
+            worker.wait(10)
+
+    @staticmethod
+    def result(latencies, errors, wall, cards=None):
+        result = {
+            "requests": len(latencies) + errors,
+            "errors": errors,
+            "wall_s": round(wall, 3),
+            "requests_per_sec": round(len(latencies) / wall, 2) if wall else None,
+            "latency_ms": latency_summary(latencies),
+        }
+        if cards is not None:
+            result["cards_per_sec"] = round(cards / wall, 2) if wall else None
+        return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline):
+    # Prints p50/p95/cards-per-sec changes for the scenarios both runs have
+    def rows(results, prefix=""):
+        for name, value in results.items():
+            if isinstance(value, dict) and "latency_ms" in value:
+                yield prefix + name, value
+            elif isinstance(value, dict):
+                yield from rows(value, f"{prefix}{name}.")
+
+    before = dict(rows(baseline["scenarios"]))
+    print(f"{'scenario':<24}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, now in rows(current["scenarios"]):
+        if name not in before:
+            continue
+        metrics = [("p50 ms", before[name]["latency_ms"]["p50"], now["latency_ms"]["p50"]),
+                   ("p95 ms", before[name]["latency_ms"]["p95"], now["latency_ms"]["p95"]),
+                   ("cards/sec", before[name].get("cards_per_sec"), now.get("cards_per_sec"))]
+        for metric, old, new in metrics:
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "-"
+            print(f"{name:<24}{metric:<16}{old:>12}{new:>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the card generation pipeline against a fake VLM server")
+    parser.add_argument("--scenarios", default="generate,batch,batch_stream,packs,cards,startup",
+                        help="comma-separated subset of generate,batch,batch_stream,packs,cards,startup")
+    parser.add_argument("--requests", type=int, default=20, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=5, help="images per batch-generate request")
+    parser.add_argument("--pack-images", type=int, default=20, help="images uploaded in the packs scenario")
+    parser.add_argument("--library-size", type=int, default=1000, help="cards in the library for the cards scenario")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh workers started in the startup scenario")
+    parser.add_argument("--image-size", type=lambda v: tuple(int(x) for x in v.split("x")), default=(1200, 900),
+                        help="WIDTHxHEIGHT of the generated images")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake VLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="fake VLM latency jitter in seconds")
+    parser.add_argument("--port", type=int, default=0, help="app port (0 picks a free one)")
+    parser.add_argument("--env", action="append", default=[], type=lambda v: tuple(v.split("=", 1)),
+                        help="extra NAME=VALUE app setting, e.g. --env VLM_BATCH_SIZE=5 (repeatable)")
+    parser.add_argument("--workdir", help="directory for the app's data (default: a temp dir, removed afterwards)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cardgen-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    if not os.path.exists(os.path.join(workdir, "static")):
+        shutil.copytree(os.path.join(REPO_DIR, "static"), os.path.join(workdir, "static"),
+                        ignore=shutil.ignore_patterns("*.gz", "*.br"))
+    os.chdir(workdir)
+
+    fake = FakeVLMServer(args.latency, args.jitter).start()
+    bench = Benchmark(args)
+    runners = {"generate": bench.run_generate, "batch": bench.run_batch, "batch_stream": bench.run_batch_stream,
+               "packs": bench.run_packs, "cards": bench.run_cards, "startup": bench.run_startup}
+    scenarios = {}
+    try:
+        # The app logs with print(); keep stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            bench.start_app(fake.url)
+            for name in args.scenarios.split(","):
+                scenarios[name] = bench.scenario(name, runners[name])
+    finally:
+        bench.stop_app()
+        fake.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": int(time.time()),
+            "python": sys.version.split()[0],
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+        },
+        "fake_vlm": {"requests": fake.requests, "images": fake.images},
+        # Includes the load generator, which runs in the same process
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "scenarios": scenarios,
+    }
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
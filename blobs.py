@@ -0,0 +1,125 @@
+import os
+import shutil
+import uuid
+from typing import Optional
+
+# Where uploaded images and their thumbnails live. Every node keeps a local
+# copy under its upload directory; the blob store is the copy all nodes share.
+
+
+class FileBlobStore:
+    # Blobs as files under `root`, e.g. a mount shared by all nodes. With root
+    # set to the upload directory itself (the default) put/fetch do nothing.
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def put(self, name: str, path: str):
+        target = self._path(name)
+        if os.path.exists(target):
+            return # Content-addressed names: same name, same bytes
+        # Created on first write, so opening the store touches nothing
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, target)
+
+    def fetch(self, name: str, dest: str) -> bool:
+        # Copies the blob to dest; False if there is no such blob
+        source = self._path(name)
+        if not os.path.exists(source):
+            return False
+        if os.path.exists(dest) and os.path.samefile(source, dest):
+            return True
+        temp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, dest)
+        return True
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def delete(self, name: str):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore:
+    # Objects in an S3-compatible bucket (AWS, MinIO, a local mock server via
+    # endpoint_url). boto3 is only needed for this backend and is imported on
+    # first use; `client` takes any object with the boto3 S3 client methods.
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("BLOB_STORE=s3 requires boto3 (pip install boto3)")
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url, region_name=self.region)
+        return self._client
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}{name}"
+
+    @staticmethod
+    def _is_missing(error) -> bool:
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, name: str, path: str):
+        with open(path, "rb") as f:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(name), Body=f)
+
+    def fetch(self, name: str, dest: str) -> bool:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(name))
+        except Exception as e:
+            if self._is_missing(e):
+                return False
+            raise
+        temp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in iter(lambda: response["Body"].read(1024 * 1024), b""):
+                    f.write(chunk)
+            os.replace(temp_path, dest)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return True
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+        except Exception as e:
+            if self._is_missing(e):
+                return False
+            raise
+        return True
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+
+def open_blob_store(backend: str = "fs", root: str = "uploads", bucket: str = "", prefix: str = "",
+                    endpoint_url: Optional[str] = None, region: Optional[str] = None):
+    if backend == "fs":
+        return FileBlobStore(root)
+    if backend == "s3":
+        if not bucket:
+            raise ValueError("BLOB_STORE=s3 requires S3_BUCKET")
+        return S3BlobStore(bucket, prefix, endpoint_url=endpoint_url, region=region)
+    raise ValueError(f"Unknown blob store backend: {backend}")
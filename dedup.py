@@ -0,0 +1,109 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # Burkhard-Keller tree over 64-bit perceptual hashes. A query with radius r
+    # only descends into children whose edge distance d satisfies |d - dist| <= r,
+    # so small radii touch a small fraction of the tree.
+    def __init__(self):
+        self._root = None # [hash, [md5, ...], {distance: child}]
+        self.size = 0
+
+    def add(self, value: int, md5: str):
+        node = self._root
+        if node is None:
+            self._root = [value, [md5], {}]
+            self.size += 1
+            return
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if md5 not in node[1]:
+                    node[1].append(md5)
+                    self.size += 1
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [md5], {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        # [(distance, md5)] within max_distance, nearest first
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, md5) for md5 in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        results.sort()
+        return results
+
+
+# Cards are stamped with created_at before their generation finishes, so a
+# catch-up query looks back this far past the previous one
+SYNC_MARGIN = 600
+
+
+class NearDuplicateIndex:
+    # In-memory BK-tree of every card's perceptual hash, loaded lazily from the
+    # store. Other workers' cards are picked up incrementally whenever the
+    # store's cards_version changes.
+    def __init__(self, store):
+        self.store = store
+        self._tree = BKTree()
+        self._known: Dict[str, int] = {}
+        self._since = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _sync(self):
+        version = self.store.cards_version()[0]
+        if version == self._version:
+            return
+        started = time.time()
+        for md5, phash in self.store.card_phashes(self._since):
+            self._add(md5, int(phash, 16))
+        self._version = version
+        self._since = started - SYNC_MARGIN
+
+    def _add(self, md5: str, value: int):
+        if self._known.get(md5) == value:
+            return
+        self._known[md5] = value
+        self._tree.add(value, md5)
+
+    def load(self):
+        with self._lock:
+            self._sync()
+
+    def add(self, md5: str, phash: str):
+        with self._lock:
+            self._add(md5, int(phash, 16))
+
+    def find(self, phash: str, max_distance: int, exclude: Optional[str] = None) -> Optional[Tuple[str, int]]:
+        # (md5, distance) of the closest other card within max_distance, or None
+        value = int(phash, 16)
+        with self._lock:
+            self._sync()
+            matches = self._tree.search(value, max_distance)
+            for distance, md5 in matches:
+                # Regenerated cards keep their old hash in the tree; trust the latest one
+                if md5 != exclude and hamming(self._known[md5], value) == distance:
+                    return md5, distance
+        return None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"cards": len(self._known), "entries": self._tree.size}
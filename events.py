@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+import time
+import traceback
+import uuid
+from typing import List, Optional, Tuple
+
+from storage import SQLiteDatabase
+
+EVENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class EventLog(SQLiteDatabase):
+    # Events of every process sharing the database, so each one can pass the
+    # others' events on to its own subscribers
+    schema = EVENTS_SCHEMA
+
+    def append(self, origin: str, message: str):
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT INTO events (origin, message, created_at) VALUES (?, ?, ?)", (origin, message, time.time())
+            )
+
+    def read(self, after_id: int, exclude_origin: str, limit: int = 500) -> List[Tuple[int, str]]:
+        return self._conn().execute(
+            "SELECT id, message FROM events WHERE id > ? AND origin != ? ORDER BY id LIMIT ?",
+            (after_id, exclude_origin, limit),
+        ).fetchall()
+
+    def last_id(self) -> int:
+        return self._conn().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def prune(self, max_age: float):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - max_age,))
+
+
+class EventBroker:
+    # Fans out server-sent events to subscribers. publish() may be called from
+    # any thread; each subscriber is an asyncio.Queue on its own event loop.
+    # With an EventLog, events are also shared with the other processes using
+    # it: start() relays theirs, polling every `poll_interval` seconds.
+    def __init__(self, max_queue: int = 256, log: Optional[EventLog] = None, poll_interval: float = 0.5,
+                 retention: float = 3600.0):
+        self.max_queue = max_queue
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self.log = log
+        self.origin = uuid.uuid4().hex
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._stopping = threading.Event()
+        self._relay_thread = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event: str, data):
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self._fan_out(message)
+        if self.log is not None:
+            try:
+                self.log.append(self.origin, message)
+            except Exception as e:
+                print(f"Event log append failed: {e}")
+
+    def start(self):
+        if self.log is None or self._relay_thread is not None:
+            return
+        self._stopping.clear()
+        self._relay_thread = threading.Thread(target=self._relay, name="event-relay", daemon=True)
+        self._relay_thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        thread, self._relay_thread = self._relay_thread, None
+        if thread is not None:
+            thread.join(timeout)
+
+    def _relay(self):
+        last_id = self.log.last_id()
+        last_prune = 0.0
+        while not self._stopping.wait(self.poll_interval):
+            try:
+                if not self.subscriber_count():
+                    # Nobody to tell, skip what happened meanwhile
+                    last_id = self.log.last_id()
+                else:
+                    for event_id, message in self.log.read(last_id, self.origin):
+                        self._fan_out(message)
+                        last_id = event_id
+                if time.monotonic() - last_prune > 60:
+                    self.log.prune(self.retention)
+                    last_prune = time.monotonic()
+            except Exception:
+                traceback.print_exc()
+
+    def _fan_out(self, message: str):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, message)
+            except RuntimeError:
+                # Loop already closed
+                self.unsubscribe(queue)
+
+    @staticmethod
+    def _offer(queue, message):
+        # A slow client loses events rather than blocking the publisher
+        if not queue.full():
+            queue.put_nowait(message)
@@ -0,0 +1,122 @@
+import os
+import uuid
+from typing import Dict
+
+# Card faces are 320px wide; 640 covers high-DPI screens
+THUMBNAIL_WIDTHS = [320, 640]
+THUMBNAIL_FORMATS = {"webp": ("WEBP", 80), "jpeg": ("JPEG", 82)}
+
+
+def thumbnail_filename(md5: str, width: int, fmt: str) -> str:
+    ext = "jpg" if fmt == "jpeg" else fmt
+    return f"{md5}_w{width}.{ext}"
+
+
+def generate_thumbnails(original_path: str, md5: str, upload_dir: str, url_prefix: str = "/uploads") -> Dict[str, Dict[str, str]]:
+    # Writes resized copies next to the original and returns their URLs as
+    # {"320": {"webp": ..., "jpeg": ...}, ...}. Existing files are reused.
+    from PIL import Image, ImageOps
+
+    thumbnails = {}
+    with Image.open(original_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        for width in THUMBNAIL_WIDTHS:
+            resized = None
+            urls = {}
+            for fmt, (pil_format, quality) in THUMBNAIL_FORMATS.items():
+                filename = thumbnail_filename(md5, width, fmt)
+                path = os.path.join(upload_dir, filename)
+                if not os.path.exists(path):
+                    if resized is None:
+                        resized = img.copy()
+                        # Never upscales
+                        resized.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+                    # Unique per writer: a request and the backfill may write the same file
+                    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                    resized.save(temp_path, format=pil_format, quality=quality)
+                    os.replace(temp_path, path)
+                urls[fmt] = f"{url_prefix}/{filename}"
+            thumbnails[str(width)] = urls
+    return thumbnails
+
+
+def dhash(path: str, hash_size: int = 8) -> int:
+    # Difference hash: one bit per horizontally adjacent pixel pair of a
+    # (hash_size + 1) x hash_size greyscale copy. Survives resizing and
+    # re-compression; near-identical images differ in a few bits.
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as img:
+        # JPEGs decode straight at 1/2 to 1/8 scale; the hash only needs a few pixels
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def format_phash(value: int) -> str:
+    return f"{value:016x}"
+
+
+if __name__ == "__main__":
+    # python images.py backfill: create missing thumbnails and perceptual hashes for existing cards
+    import sys
+
+    from blobs import open_blob_store
+    from storage import open_store
+
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("usage: python images.py backfill")
+        sys.exit(1)
+
+    upload_dir = os.getenv("UPLOAD_DIR", "uploads")
+    store = open_store(
+        os.getenv("STORAGE_BACKEND", "sqlite"),
+        db_path=os.getenv("CARDGEN_DB", "cardgen.db")
+    )
+    # Same settings as the app: originals missing here come from the blob
+    # store, and new thumbnails go to it so every host can serve them
+    blobs = open_blob_store(
+        os.getenv("BLOB_STORE", "fs"),
+        root=os.getenv("BLOB_DIR", upload_dir),
+        bucket=os.getenv("S3_BUCKET", ""),
+        prefix=os.getenv("S3_PREFIX", ""),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        region=os.getenv("S3_REGION") or None
+    )
+
+    os.makedirs(upload_dir, exist_ok=True)
+    updated = 0
+    failed = 0
+    for card in store.list_cards(include_hidden=True):
+        original_path = os.path.join(upload_dir, card["filename"])
+        try:
+            if not os.path.exists(original_path) and not blobs.fetch(card["filename"], original_path):
+                continue
+            thumbnails = generate_thumbnails(original_path, card["md5"], upload_dir)
+            for urls in thumbnails.values():
+                for url in urls.values():
+                    name = os.path.basename(url)
+                    if not blobs.exists(name):
+                        blobs.put(name, os.path.join(upload_dir, name))
+            phash = card.get("phash") or format_phash(dhash(original_path))
+        except Exception as e:
+            print(f"Skipping {card['md5']}: {e}")
+            failed += 1
+            continue
+        if card.get("thumbnails") != thumbnails or card.get("phash") != phash:
+            card["thumbnails"] = thumbnails
+            card["phash"] = phash
+            store.put_card(card)
+            updated += 1
+
+    print(f"Updated {updated} cards, {failed} failed")
@@ -0,0 +1,246 @@
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from typing import Optional, List, Dict, Callable
+
+from storage import SQLiteDatabase
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pack_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    file_path TEXT NOT NULL,
+    file_md5 TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL DEFAULT 0,
+    result_md5 TEXT,
+    error TEXT,
+    created_at INTEGER,
+    updated_at INTEGER,
+    claimed_by TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, next_run_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_pack ON jobs(pack_id);
+"""
+
+JOB_COLUMNS = ["id", "pack_id", "position", "file_path", "file_md5", "status", "attempts", "result_md5", "error"]
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue(SQLiteDatabase):
+    # Durable per-image generation jobs. Status goes queued -> running -> done/failed,
+    # failed attempts go back to queued with a later next_run_at until max attempts.
+    # Any process sharing the database can claim a job; a running job is leased
+    # to its worker, and one whose lease ran out (the worker died) is claimed again.
+    schema = JOBS_SCHEMA
+
+    def migrate(self, conn):
+        self._add_column(conn, "jobs", "file_md5", "TEXT")
+        self._add_column(conn, "jobs", "claimed_by", "TEXT")
+        self._add_column(conn, "jobs", "lease_until", "REAL")
+
+    def enqueue(self, jobs: List[Dict]):
+        now = int(time.time())
+        with self._tx() as conn:
+            conn.executemany(
+                "INSERT INTO jobs (pack_id, position, file_path, file_md5, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job["pack_id"], job["position"], job["file_path"], job.get("file_md5"), now, now) for job in jobs],
+            )
+
+    def claim(self, worker: str = "", lease: float = 60.0) -> Optional[Dict]:
+        now = time.time()
+        with self._tx() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE (status = 'queued' AND next_run_at <= ?) "
+                "OR (status = 'running' AND COALESCE(lease_until, 0) < ?) ORDER BY id LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if not row:
+                return None
+            job = dict(zip(JOB_COLUMNS, row))
+            job["attempts"] += 1
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = ?, updated_at = ?, claimed_by = ?, lease_until = ? "
+                "WHERE id = ?",
+                (job["attempts"], int(now), worker, now + lease, job["id"]),
+            )
+        return job
+
+    def renew(self, job_ids: List[int], worker: str, lease: float = 60.0):
+        # Extends the leases this worker still holds
+        if not job_ids:
+            return
+        with self._tx() as conn:
+            conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE status = 'running' AND claimed_by = ? "
+                f"AND id IN ({', '.join('?' * len(job_ids))})",
+                [time.time() + lease, worker, *job_ids],
+            )
+
+    def update_file_path(self, job_id: int, file_path: str):
+        with self._tx() as conn:
+            conn.execute("UPDATE jobs SET file_path = ? WHERE id = ?", (file_path, job_id))
+
+    def complete(self, job_id: int, result_md5: Optional[str], error: Optional[str] = None) -> bool:
+        # Marks the job done (or failed when result_md5 is None). Returns True for
+        # exactly one caller per pack: the one that finished the pack's last job.
+        status = "done" if result_md5 else "failed"
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result_md5 = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, result_md5, error, int(time.time()), job_id),
+            )
+            pack_id = conn.execute("SELECT pack_id FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            remaining = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE pack_id = ? AND status IN ('queued', 'running')",
+                (pack_id,),
+            ).fetchone()[0]
+        return remaining == 0
+
+    def retry(self, job_id: int, delay: float, error: str):
+        with self._tx() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', next_run_at = ?, error = ?, updated_at = ? WHERE id = ?",
+                (time.time() + delay, error, int(time.time()), job_id),
+            )
+
+    def recover(self) -> int:
+        # Jobs left running by a dead worker go back on the queue. Live workers
+        # keep renewing their leases, so their jobs are left alone.
+        with self._tx() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', next_run_at = 0 "
+                "WHERE status = 'running' AND COALESCE(lease_until, 0) < ?",
+                (time.time(),),
+            )
+            return cur.rowcount
+
+    def pack_results(self, pack_id: str) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT result_md5 FROM jobs WHERE pack_id = ? AND status = 'done' ORDER BY position",
+            (pack_id,),
+        )
+        return [row[0] for row in rows]
+
+    def pack_progress(self, pack_id: str) -> Dict[str, int]:
+        finished, total = self._conn().execute(
+            "SELECT SUM(status IN ('done', 'failed')), COUNT(*) FROM jobs WHERE pack_id = ?",
+            (pack_id,),
+        ).fetchone()
+        return {"done": finished or 0, "total": total}
+
+    def unfinished_packs(self) -> List[str]:
+        rows = self._conn().execute("SELECT DISTINCT pack_id FROM jobs WHERE status IN ('queued', 'running')")
+        return [row[0] for row in rows]
+
+    def depth(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+
+class JobWorkerPool:
+    # N threads pulling from a JobQueue. handler(job) returns the card md5;
+    # on_job_done(job, md5) runs after every finished job (md5 is None if it failed)
+    # and on_pack_done(pack_id) once when the last job of a pack finishes.
+    # Claimed jobs are leased for `lease` seconds and renewed while they run.
+    def __init__(self, queue: JobQueue, handler: Callable[[Dict], str], on_pack_done: Callable[[str], None],
+                 workers: int = 4, max_attempts: int = 3, backoff_base: float = 2.0, poll_interval: float = 1.0,
+                 on_job_done: Optional[Callable[[Dict, Optional[str]], None]] = None, lease: float = 60.0):
+        self.queue = queue
+        self.worker_id = worker_id()
+        self.lease = lease
+        self._active = set()
+        self._active_lock = threading.Lock()
+        self.handler = handler
+        self.on_pack_done = on_pack_done
+        self.on_job_done = on_job_done
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"pack-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._renew_leases, name="pack-lease", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.queue.claim(self.worker_id, self.lease)
+            except Exception as e:
+                print(f"Job queue error: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            with self._active_lock:
+                self._active.add(job["id"])
+            try:
+                self._process(job)
+            finally:
+                with self._active_lock:
+                    self._active.discard(job["id"])
+
+    def _renew_leases(self):
+        while not self._stopping.wait(self.lease / 3):
+            with self._active_lock:
+                job_ids = list(self._active)
+            try:
+                self.queue.renew(job_ids, self.worker_id, self.lease)
+            except Exception as e:
+                print(f"Job lease renewal failed: {e}")
+
+    def _process(self, job):
+        try:
+            result_md5 = self.handler(job)
+            pack_done = self.queue.complete(job["id"], result_md5)
+        except Exception as e:
+            traceback.print_exc()
+            if job["attempts"] < self.max_attempts:
+                delay = self.backoff_base * (2 ** (job["attempts"] - 1)) * random.uniform(0.5, 1.5)
+                print(f"Job {job['id']} failed (attempt {job['attempts']}), retrying in {delay:.1f}s: {e}")
+                self.queue.retry(job["id"], delay, str(e))
+                return
+            print(f"Job {job['id']} failed after {job['attempts']} attempts: {e}")
+            result_md5 = None
+            pack_done = self.queue.complete(job["id"], None, str(e))
+
+        try:
+            if self.on_job_done:
+                self.on_job_done(job, result_md5)
+            if pack_done:
+                self.on_pack_done(job["pack_id"])
+        except Exception:
+            traceback.print_exc()
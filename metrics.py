@@ -0,0 +1,179 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+# Seconds; covers everything from a dedup lookup to a slow VLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: List[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = list(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: List[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = list(labelnames)
+        self.buckets = list(buckets) + [float("inf")]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    le = _format_value(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+class Gauge:
+    # Read at scrape time: collect() returns a number, or {label values tuple: number}
+    def __init__(self, name: str, help_text: str, collect: Callable, labelnames: List[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+        self.labelnames = list(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, collect, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help_text, collect, labelnames))
+
+    def render(self) -> str:
+        # Prometheus text exposition format 0.0.4
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "cardgen_stage_seconds", "Time spent in each stage of generating a card", ["stage"])
+VLM_CALL_SECONDS = REGISTRY.histogram(
+    "cardgen_vlm_call_seconds", "Duration of VLM chat completions by prompt", ["prompt"])
+VLM_ERRORS = REGISTRY.counter(
+    "cardgen_vlm_errors_total", "Failed VLM requests by endpoint and kind", ["endpoint", "kind"])
+STUB_FALLBACKS = REGISTRY.counter(
+    "cardgen_stub_fallbacks_total", "Analyses answered by the stub after the VLM failed", ["reason"])
+DEDUP_HITS = REGISTRY.counter(
+    "cardgen_dedup_hits_total", "Uploads that matched an existing card", ["source"])
+CARDS_GENERATED = REGISTRY.counter(
+    "cardgen_cards_generated_total", "Cards created or regenerated")
+NEAR_DUP_HITS = REGISTRY.counter(
+    "cardgen_near_duplicate_hits_total", "New images matched to a similar existing card", ["mode"])
+ANALYSIS_CACHE = REGISTRY.counter(
+    "cardgen_analysis_cache_total", "Analysis cache lookups", ["result"])
+
+# When true, every span is also printed as a JSON line
+trace_spans = False
+
+
+@contextmanager
+def span(stage: str, **fields):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if trace_spans:
+            print(json.dumps(dict(fields, span=stage, seconds=round(elapsed, 6), thread=threading.current_thread().name)))
+
+
+def timed(stage: str):
+    # Decorator form of span(), also usable on bound methods: timed("x")(obj.method)
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
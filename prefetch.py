@@ -0,0 +1,91 @@
+import queue
+import random
+import threading
+import traceback
+from typing import Callable, Optional, Any
+
+
+class Prefetcher:
+    # Keeps up to `size` items produced by fetch() ready to take. `workers` threads
+    # refill the pool as items are taken; fetch() returns None when it got nothing,
+    # which makes that worker back off for about `retry_delay` seconds.
+    # discard(item) cleans up items that are never taken.
+    def __init__(self, fetch: Callable[[], Optional[Any]], discard: Callable[[Any], None],
+                 size: int = 10, workers: int = 4, retry_delay: float = 2.0):
+        self.fetch = fetch
+        self.discard = discard
+        self.size = max(1, size)
+        self.workers = max(1, workers)
+        self.retry_delay = retry_delay
+        self._items = queue.Queue()
+        # One slot per item that is ready or being fetched, so the pool never overfills
+        self._slots = threading.Semaphore(self.size)
+        self._stopping = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            self._slots = threading.Semaphore(max(0, self.size - self._items.qsize()))
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"prefetch-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._slots.release() # Wakes workers waiting for a slot
+        for thread in threads:
+            thread.join(timeout)
+        while True:
+            try:
+                item = self._items.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(item)
+
+    def take(self, timeout: Optional[float] = None) -> Optional[Any]:
+        # Starts the workers on first use; None if nothing arrived within timeout
+        self.start()
+        try:
+            item = self._items.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._slots.release()
+        return item
+
+    def ready(self) -> int:
+        return self._items.qsize()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._slots.acquire()
+            if self._stopping.is_set():
+                return
+
+            try:
+                item = self.fetch()
+            except Exception:
+                traceback.print_exc()
+                item = None
+
+            if item is None:
+                self._slots.release()
+                self._stopping.wait(self.retry_delay * random.uniform(0.5, 1.5))
+                continue
+            if self._stopping.is_set():
+                self._discard(item)
+                return
+            self._items.put(item)
+
+    def _discard(self, item):
+        try:
+            self.discard(item)
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, Optional
+
+# Server-side card images, laid out like the .card-front / .card-back CSS in
+# static/css/style.css at 320x480 and scaled up. Bump TEMPLATE_VERSION with
+# every visual change; it is part of the cache key.
+TEMPLATE_VERSION = "1"
+CARD_WIDTH = 320
+CARD_HEIGHT = 480
+RENDER_FORMATS = {"png": ("PNG", {}), "webp": ("WEBP", {"quality": 90})}
+FACES = ("front", "back")
+
+# (background, border). A pair of backgrounds is a top-left to bottom-right gradient.
+RARITY_COLORS = {
+    "N": ("#c07838", "#3d3d3d"),
+    "R": ("#95a5a6", "#7f8c8d"),
+    "SR": ("#f39c12", "#d35400"),
+    "SSR": ("#8e44ad", "#2c3e50"),
+    "UR": (("#2c3e50", "#000000"), "#f1c40f"),
+}
+THEME_COLORS = {
+    "theme-gray": ("#7f8c8d", "#555555"),
+    "theme-pale-blue": ("#aab7b8", "#7f8c8d"),
+    "theme-pale-green": ("#a2b9bc", "#7f8c8d"),
+    "theme-bronze": ("#cd7f32", "#8c5a2b"),
+    "theme-silver": ("#bdc3c7", "#7f8c8d"),
+    "theme-steel": ("#778899", "#2c3e50"),
+    "theme-gold": ("#f1c40f", "#d35400"),
+    "theme-orange": ("#e67e22", "#d35400"),
+    "theme-crimson": ("#c0392b", "#922b21"),
+    "theme-purple": ("#9b59b6", "#8e44ad"),
+    "theme-magenta": ("#dda0dd", "#800080"),
+    "theme-deep-blue": ("#34495e", "#2c3e50"),
+    "theme-rainbow": (("#ff9a9e", "#fecfef"), "#ff6b6b"),
+    "theme-black-gold": (("#000000", "#434343"), "#f1c40f"),
+    "theme-galaxy": (("#2b1055", "#7597de"), "#ffffff"),
+}
+
+# Tried in order; names need CJK glyphs, so CJK fonts come first
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+
+# Card fields that show up in the image
+RENDERED_FIELDS = ["md5", "name", "rarity", "description", "atk", "def", "color_theme", "card_back"]
+
+
+def find_font(configured: Optional[str] = None) -> Optional[str]:
+    for path in ([configured] if configured else []) + FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+def render_key(card: Dict, face: str = "front", fmt: str = "png", scale: int = 2) -> str:
+    # Content hash of everything that affects the output
+    content = {field: card.get(field) for field in RENDERED_FIELDS}
+    content.update(template=TEMPLATE_VERSION, face=face, format=fmt, scale=scale)
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:32]
+
+
+def _font(path, size):
+    from PIL import ImageFont
+
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size)
+
+
+def _fill(img, box, color, radius=0):
+    # Solid color or a diagonal gradient, clipped to a rounded rectangle
+    from PIL import Image, ImageDraw
+
+    x0, y0, x1, y1 = box
+    width, height = x1 - x0, y1 - y0
+    if isinstance(color, tuple):
+        start, end = Image.new("RGB", (1, 1), color[0]), Image.new("RGB", (1, 1), color[1])
+        mask = Image.linear_gradient("L").rotate(45, expand=True).resize((width, height))
+        layer = Image.composite(end.resize((width, height)), start.resize((width, height)), mask)
+    else:
+        layer = Image.new("RGB", (width, height), color)
+    shape = Image.new("L", (width, height), 0)
+    ImageDraw.Draw(shape).rounded_rectangle((0, 0, width - 1, height - 1), radius=radius, fill=255)
+    img.paste(layer, (x0, y0), shape)
+
+
+def _cover(image, size):
+    # Like CSS background-size: cover, centered
+    from PIL import ImageOps
+
+    return ImageOps.fit(image, size, method=3, centering=(0.5, 0.5))
+
+
+def _wrap(draw, text, font, width, max_lines):
+    # Character-level wrapping, so text without spaces (Chinese) wraps too
+    lines, line = [], ""
+    for char in text.replace("\n", " "):
+        if draw.textlength(line + char, font=font) <= width:
+            line += char
+            continue
+        lines.append(line)
+        line = char.lstrip()
+        if len(lines) == max_lines:
+            break
+    else:
+        if line:
+            lines.append(line)
+        return lines
+    last = lines[-1]
+    while last and draw.textlength(last + "…", font=font) > width:
+        last = last[:-1]
+    lines[-1] = last + "…"
+    return lines
+
+
+def _fit_text(draw, text, font, width):
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font) > width:
+        text = text[:-1]
+    return text + "…"
+
+
+def render_front(card: Dict, image_path: Optional[str], font_path: Optional[str], scale: int = 2):
+    from PIL import Image, ImageDraw
+
+    def s(value):
+        return int(round(value * scale))
+
+    width, height = s(CARD_WIDTH), s(CARD_HEIGHT)
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    rarity = str(card.get("rarity", "N")).upper()
+    background, border = THEME_COLORS.get(card.get("color_theme"), RARITY_COLORS.get(rarity, RARITY_COLORS["N"]))
+    _fill(img, (0, 0, width, height), border, radius=s(15))
+    _fill(img, (s(8), s(8), width - s(8), height - s(8)), background, radius=s(8))
+    draw = ImageDraw.Draw(img)
+
+    left, right = s(20), width - s(20)
+
+    # Header: name and rarity badge
+    top = s(20)
+    header_bottom = top + s(38)
+    draw.rounded_rectangle((left, top, right, header_bottom), radius=s(4), fill=(255, 255, 255, 230),
+                           outline="#000000", width=max(1, s(1)))
+    badge = s(28)
+    badge_x = right - s(8) - badge
+    badge_y = top + (header_bottom - top - badge) // 2
+    draw.ellipse((badge_x, badge_y, badge_x + badge, badge_y + badge), fill="#ecf0f1", outline="#000000",
+                 width=max(1, s(1)))
+    badge_font = _font(font_path, s(11))
+    draw.text((badge_x + badge / 2, badge_y + badge / 2), rarity, font=badge_font, fill="#000000", anchor="mm")
+    name_font = _font(font_path, s(17))
+    name = _fit_text(draw, str(card.get("name", "")), name_font, badge_x - left - s(16))
+    draw.text((left + s(8), (top + header_bottom) / 2), name, font=name_font, fill="#000000", anchor="lm")
+
+    # Artwork
+    art_top = header_bottom + s(8)
+    art_bottom = art_top + s(240)
+    draw.rectangle((left, art_top, right, art_bottom), fill="#000000", outline="#7f8c8d", width=s(4))
+    if image_path and os.path.exists(image_path):
+        try:
+            with Image.open(image_path) as art:
+                art = art.convert("RGB")
+                inner = (right - left - s(8), art_bottom - art_top - s(8))
+                img.paste(_cover(art, inner), (left + s(4), art_top + s(4)))
+        except OSError as e:
+            print(f"Render: cannot read {image_path}: {e}")
+
+    # Info box: type line, description, ATK/DEF
+    info_top = art_bottom + s(8)
+    info_bottom = height - s(20)
+    draw.rounded_rectangle((left, info_top, right, info_bottom), radius=s(4), fill=(255, 255, 255, 242),
+                           outline="#000000", width=s(2))
+    text_left, text_right = left + s(8), right - s(8)
+    type_font = _font(font_path, s(14))
+    y = info_top + s(8)
+    draw.text((text_left, y), "[ AI / Effect ]", font=type_font, fill="#000000")
+    y += s(18)
+    draw.line((text_left, y, text_right, y), fill="#000000", width=max(1, s(1)))
+
+    stats_font = _font(font_path, s(14))
+    stats_top = info_bottom - s(8) - s(18)
+    desc_font = _font(font_path, s(13))
+    line_height = s(17)
+    max_lines = max(1, (stats_top - y - s(4)) // line_height)
+    y += s(4)
+    for line in _wrap(draw, str(card.get("description", "")), desc_font, text_right - text_left, min(4, max_lines)):
+        draw.text((text_left, y), line, font=desc_font, fill="#000000")
+        y += line_height
+
+    draw.line((text_left, stats_top, text_right, stats_top), fill="#000000", width=max(1, s(1)))
+    stats = f"ATK / {card.get('atk', '0')}    DEF / {card.get('def', '0')}"
+    draw.text((text_right, stats_top + s(2)), stats, font=stats_font, fill="#000000", anchor="ra")
+    return img
+
+
+def render_back(back_path: Optional[str], scale: int = 2):
+    from PIL import Image, ImageDraw
+
+    width, height = int(CARD_WIDTH * scale), int(CARD_HEIGHT * scale)
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    shape = Image.new("L", (width, height), 0)
+    ImageDraw.Draw(shape).rounded_rectangle((0, 0, width - 1, height - 1), radius=int(15 * scale), fill=255)
+    back = None
+    # PIL cannot rasterize SVG backs; those get the plain black back
+    if back_path and os.path.exists(back_path) and not back_path.lower().endswith(".svg"):
+        try:
+            with Image.open(back_path) as source:
+                back = _cover(source.convert("RGB"), (width, height))
+        except OSError as e:
+            print(f"Render: cannot read {back_path}: {e}")
+    img.paste(back or Image.new("RGB", (width, height), "#000000"), (0, 0), shape)
+    return img
+
+
+def render_file(card: Dict, image_path: Optional[str], back_path: Optional[str], dest: str,
+                face: str = "front", fmt: str = "png", scale: int = 2, font_path: Optional[str] = None) -> str:
+    # Renders one face to dest (atomically) and returns dest. Runs in worker
+    # processes for bulk exports, so everything it needs comes in as arguments.
+    if os.path.exists(dest):
+        return dest
+    img = render_back(back_path, scale) if face == "back" else render_front(card, image_path, font_path, scale)
+    pil_format, options = RENDER_FORMATS[fmt]
+    temp_path = f"{dest}.{uuid.uuid4().hex}.tmp"
+    img.save(temp_path, format=pil_format, **options)
+    os.replace(temp_path, dest)
+    return dest
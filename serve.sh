@@ -1 +1,6 @@
-uvicorn app:app --port 8100 --host 0.0.0.0
+# WORKERS=4 ./serve.sh runs several worker processes sharing cardgen.db
+WORKERS=${WORKERS:-1}
+if [ "$WORKERS" -gt 1 ]; then
+    export DEPLOYMENT_MODE=${DEPLOYMENT_MODE:-shared}
+fi
+uvicorn app:app --port 8100 --host 0.0.0.0 --workers "$WORKERS"
@@ -37,13 +37,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const files = Array.from(e.target.files);
         if (files.length > 0) {
             batchGenerateBtn.disabled = false;
-            if (files.length > 10) {
-                fileCount.textContent = `${files.length} files selected (Only 10 random files will be processed)`;
-                fileCount.style.color = '#ffaa00';
-            } else {
-                fileCount.textContent = `${files.length} files selected`;
-                fileCount.style.color = '#ccc';
-            }
+            fileCount.textContent = `${files.length} files selected`;
+            fileCount.style.color = '#ccc';
         } else {
             batchGenerateBtn.disabled = true;
             fileCount.textContent = "0 files selected";
@@ -71,23 +66,46 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         try {
-            const response = await fetch('/api/batch-generate', {
+            const response = await fetch('/api/batch-generate?stream=true', {
                 method: 'POST',
                 body: formData
             });
 
-            if (!response.ok) throw new Error('Batch generation failed');
-
-            const cards = await response.json();
+            if (!response.ok) {
+                const error = await response.json().catch(() => ({}));
+                throw new Error(error.detail || 'Batch generation failed');
+            }
 
-            statusText.textContent = `Summoned ${cards.length} cards! Click to reveal them.`;
+            // One card per line, rendered as each one is summoned
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let count = 0;
+            const failed = [];
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                const results = lines.filter(line => line.trim()).map(line => JSON.parse(line));
+                const cards = results.filter(result => !result.error);
+                results.filter(result => result.error).forEach(result => {
+                    console.error(`${result.filename}: ${result.error}`);
+                    failed.push(result.filename);
+                });
+                count += cards.length;
+                renderBatchCards(cards, selectedCardBackUrl);
+                if (cards.length) statusText.textContent = `Summoned ${count} of ${files.length} cards so far...`;
+            }
 
-            renderBatchCards(cards, selectedCardBackUrl);
+            statusText.textContent = `Summoned ${count} cards! Click to reveal them.`;
+            if (failed.length) statusText.textContent += ` (failed: ${failed.join(', ')})`;
 
         } catch (error) {
             console.error(error);
             statusText.textContent = "Summoning failed!";
-            alert('Failed to generate cards. Please try again.');
+            alert(`Failed to generate cards: ${error.message}`);
         } finally {
             batchGenerateBtn.disabled = false;
         }
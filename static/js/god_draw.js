@@ -12,17 +12,30 @@ document.addEventListener('DOMContentLoaded', () => {
         batchGrid.innerHTML = '';
 
         try {
-            const response = await fetch('/api/god-draw', {
+            const response = await fetch('/api/god-draw?stream=true', {
                 method: 'POST'
             });
 
             if (!response.ok) throw new Error('God Draw failed');
 
-            const cards = await response.json();
-
-            statusText.textContent = `The Gods have granted you ${cards.length} cards! Click to reveal your destiny.`;
-
-            renderCards(cards);
+            // One card per line, rendered as each one is summoned
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let count = 0;
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                const cards = lines.filter(line => line.trim()).map(line => JSON.parse(line));
+                count += cards.length;
+                renderCards(cards);
+                if (cards.length) statusText.textContent = `Summoned ${count} cards so far...`;
+            }
+
+            statusText.textContent = `The Gods have granted you ${count} cards! Click to reveal your destiny.`;
 
         } catch (error) {
             console.error(error);
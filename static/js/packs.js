@@ -10,6 +10,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const backToPacksBtn = document.getElementById('backToPacksBtn');
 
     let pollInterval = null;
+    let packsById = {};
+    const supportsEvents = !!window.EventSource;
 
     // File Input
     filesInput.addEventListener('change', (e) => {
@@ -66,9 +68,13 @@ document.addEventListener('DOMContentLoaded', () => {
         fetch('/api/packs')
             .then(res => res.json())
             .then(packs => {
-                renderPacks(packs);
+                packsById = {};
+                packs.forEach(pack => { packsById[pack.id] = pack; });
+                renderPacks();
 
-                // Poll if any processing
+                if (supportsEvents) return;
+
+                // No EventSource: poll if any processing
                 const anyProcessing = packs.some(p => p.status === 'processing');
                 if (anyProcessing && !pollInterval) {
                     pollInterval = setInterval(loadPacks, 3000);
@@ -79,19 +85,61 @@ document.addEventListener('DOMContentLoaded', () => {
             });
     }
 
-    function renderPacks(packs) {
+    // Live progress pushed by the server
+    function subscribeToPackEvents() {
+        const source = new EventSource('/api/packs/events');
+        let disconnected = false;
+
+        source.addEventListener('pack', (e) => {
+            const pack = JSON.parse(e.data);
+            if (pack.status === 'opened') {
+                delete packsById[pack.id];
+            } else {
+                packsById[pack.id] = Object.assign(packsById[pack.id] || {}, pack);
+            }
+            renderPacks();
+        });
+
+        source.addEventListener('card', (e) => {
+            const data = JSON.parse(e.data);
+            const pack = packsById[data.pack_id];
+            if (!pack) return;
+            pack.progress = data.progress;
+            renderPacks();
+        });
+
+        // Events may have been missed while disconnected, resync on reconnect
+        source.addEventListener('error', () => { disconnected = true; });
+        source.addEventListener('open', () => {
+            if (disconnected) {
+                disconnected = false;
+                loadPacks();
+            }
+        });
+    }
+
+    function renderPacks() {
+        const packs = Object.values(packsById).sort((a, b) => (b.created_at || 0) - (a.created_at || 0));
         packGrid.innerHTML = '';
         packs.forEach(pack => {
             const div = document.createElement('div');
             div.className = `pack-item ${pack.status}`;
 
-            let statusLabel = pack.status === 'processing' ? 'Processing...' : 'Ready to Open';
+            let statusLabel = 'Ready to Open';
+            let cardCount = pack.cards.length;
+            if (pack.status === 'processing') {
+                statusLabel = 'Processing...';
+                if (pack.progress) {
+                    statusLabel = `Processing ${pack.progress.done}/${pack.progress.total}...`;
+                    cardCount = pack.progress.total;
+                }
+            }
             if (pack.status === 'ready') div.classList.add('ready');
 
             div.innerHTML = `
                 <div class="pack-label">Card Pack</div>
                 <div class="pack-status">${statusLabel}</div>
-                <div class="pack-status" style="font-size: 0.8em; margin-top: 5px;">Contains ${pack.cards.length} Cards</div>
+                <div class="pack-status" style="font-size: 0.8em; margin-top: 5px;">Contains ${cardCount} Cards</div>
             `;
 
             if (pack.status === 'ready') {
@@ -104,6 +152,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Initial Load
     loadPacks();
+    if (supportsEvents) subscribeToPackEvents();
 
     // Open Pack Logic
     async function openPack(packId) {
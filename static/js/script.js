@@ -23,10 +23,15 @@ document.addEventListener('DOMContentLoaded', () => {
     const closeLibraryBtn = document.getElementById('closeLibraryBtn');
     const libraryModal = document.getElementById('libraryModal');
     const librarySort = document.getElementById('librarySort');
+    const libraryRarity = document.getElementById('libraryRarity');
+    const librarySearch = document.getElementById('librarySearch');
 
     let currentFile = null;
     let currentCardData = null; // Store current card data for regenerate logic
-    let cachedLibraryCards = []; // Store fetched cards for sorting
+    const LIBRARY_PAGE_SIZE = 60;
+    let libraryCursor = null; // Cursor for the next library page, null when done
+    let libraryLoading = false;
+    let libraryRequestId = 0; // Ignore responses for outdated filters
 
     // Load Card Backs
     fetch('/api/card-backs')
@@ -120,6 +125,12 @@ document.addEventListener('DOMContentLoaded', () => {
         const imgDiv = document.createElement('div');
         imgDiv.className = 'card-art-div';
         imgDiv.style.backgroundImage = `url(${data.image_url})`;
+        // Prefer the small derivatives; browsers without image-set() keep the original
+        const thumbs = data.thumbnails && data.thumbnails['640'];
+        if (thumbs) {
+            imgDiv.style.backgroundImage = `url(${thumbs.jpeg})`;
+            imgDiv.style.backgroundImage = `image-set(url(${thumbs.webp}) type("image/webp"), url(${thumbs.jpeg}) type("image/jpeg"))`;
+        }
         imgWrapper.appendChild(imgDiv);
         
         // Info
@@ -152,44 +163,65 @@ document.addEventListener('DOMContentLoaded', () => {
         return wrapper;
     }
 
-    // Load Library
+    // Load Library (sorted, filtered and paginated by the server)
     function loadLibrary() {
-        fetch('/api/cards')
-            .then(res => res.json())
-            .then(cards => {
-                cachedLibraryCards = cards;
-                renderLibrary();
-            });
+        cardLibraryGrid.innerHTML = '';
+        libraryCursor = null;
+        libraryLoading = false;
+        libraryRequestId++;
+        loadLibraryPage();
     }
 
-    function renderLibrary() {
-        cardLibraryGrid.innerHTML = '';
+    function loadLibraryPage() {
+        if (libraryLoading) return;
+        libraryLoading = true;
+        const requestId = libraryRequestId;
 
-        // Sort cards
-        const sortValue = librarySort.value;
-        const rarityOrder = { "UR": 5, "SSR": 4, "SR": 3, "R": 2, "N": 1 };
-
-        cachedLibraryCards.sort((a, b) => {
-            if (sortValue === 'date-desc') {
-                return (b.created_at || 0) - (a.created_at || 0);
-            } else if (sortValue === 'date-asc') {
-                return (a.created_at || 0) - (b.created_at || 0);
-            } else if (sortValue === 'rarity-desc') {
-                return (rarityOrder[b.rarity] || 0) - (rarityOrder[a.rarity] || 0);
-            } else if (sortValue === 'rarity-asc') {
-                return (rarityOrder[a.rarity] || 0) - (rarityOrder[b.rarity] || 0);
-            }
-            return 0;
-        });
+        const params = new URLSearchParams({ limit: LIBRARY_PAGE_SIZE, sort: librarySort.value });
+        if (libraryRarity.value) params.set('rarity', libraryRarity.value);
+        if (librarySearch.value.trim()) params.set('q', librarySearch.value.trim());
+        if (libraryCursor) params.set('cursor', libraryCursor);
 
-        cachedLibraryCards.forEach(card => {
+        fetch(`/api/cards?${params}`)
+            .then(res => res.json())
+            .then(page => {
+                if (requestId !== libraryRequestId) return;
+                libraryCursor = page.next_cursor;
+                renderLibraryCards(page.cards);
+                libraryLoading = false;
+                loadMoreIfNeeded();
+            })
+            .finally(() => {
+                if (requestId === libraryRequestId) libraryLoading = false;
+            });
+    }
+
+    function renderLibraryCards(cards) {
+        cards.forEach(card => {
             const miniCard = createMiniCardDOM(card);
             miniCard.onclick = () => loadCardToView(card);
             cardLibraryGrid.appendChild(miniCard);
         });
     }
 
-    librarySort.addEventListener('change', renderLibrary);
+    // Fetch the next page when scrolled near the bottom. Also runs after every
+    // page: pages that fit without scrolling never fire a scroll event. A hidden
+    // grid (closed modal) has no height and waits until it is opened.
+    function loadMoreIfNeeded() {
+        if (!libraryCursor || !cardLibraryGrid.clientHeight) return;
+        const nearBottom = cardLibraryGrid.scrollTop + cardLibraryGrid.clientHeight >= cardLibraryGrid.scrollHeight - 300;
+        if (nearBottom) loadLibraryPage();
+    }
+
+    cardLibraryGrid.addEventListener('scroll', loadMoreIfNeeded);
+
+    let librarySearchTimer = null;
+    librarySort.addEventListener('change', loadLibrary);
+    libraryRarity.addEventListener('change', loadLibrary);
+    librarySearch.addEventListener('input', () => {
+        clearTimeout(librarySearchTimer);
+        librarySearchTimer = setTimeout(loadLibrary, 300);
+    });
 
     // Initial load
     loadLibrary();
@@ -356,6 +388,8 @@ document.addEventListener('DOMContentLoaded', () => {
         const formData = new FormData();
         formData.append('existing_md5', currentCardData.md5);
         formData.append('regenerate', 'true');
+        // New stats, so skip the server's analysis cache
+        formData.append('reroll', 'true');
         await performGeneration(formData);
     });
 
@@ -461,13 +495,23 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Download Button
     downloadBtn.addEventListener('click', () => {
-        if (!html2canvas) {
+        // Determine which face is visible
+        const isFlipped = cardElement.classList.contains('is-flipped');
+
+        // Saved cards are rendered by the server; html2canvas only covers the rest
+        if (currentCardData && currentCardData.md5) {
+            const link = document.createElement('a');
+            link.download = `ai-card-${currentCardData.md5}-${isFlipped ? 'back' : 'front'}.png`;
+            link.href = `/api/cards/${currentCardData.md5}/render?face=${isFlipped ? 'back' : 'front'}`;
+            link.click();
+            return;
+        }
+
+        if (!window.html2canvas) {
             alert('Download library not loaded.');
             return;
         }
 
-        // Determine which face is visible
-        const isFlipped = cardElement.classList.contains('is-flipped');
         const targetFace = isFlipped ? document.querySelector('.card-back') : document.querySelector('.card-front');
         
         // We capture the target face directly to avoid 3D transform issues in html2canvas
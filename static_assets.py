@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".html", ".svg", ".json")
+# Compressing smaller files saves next to nothing
+PRECOMPRESS_MIN_SIZE = 1024
+
+
+def _encoders():
+    encoders = []
+    if brotli is not None:
+        encoders.append(("br", ".br", lambda data: brotli.compress(data, quality=11)))
+    encoders.append(("gzip", ".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0)))
+    return encoders
+
+
+def precompress(directory: str) -> int:
+    # Writes .br (when the brotli package is installed) and .gz siblings for
+    # text assets that changed since they were last compressed.
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            stat_result = os.stat(path)
+            if stat_result.st_size < PRECOMPRESS_MIN_SIZE:
+                continue
+
+            data = None
+            for _, suffix, compress in _encoders():
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= stat_result.st_mtime:
+                    continue
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                # Several workers may compress the same file at startup
+                temp_path = f"{target}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(compress(data))
+                os.replace(temp_path, target)
+                written += 1
+    return written
+
+
+class CachedStaticFiles(StaticFiles):
+    # StaticFiles with a Cache-Control policy and precompressed variants.
+    # immutable=True marks every file as never changing (content-addressed);
+    # otherwise only requests carrying a ?v= version are cached long-term.
+    # fetch_missing(path), run in a thread, may create a file before a 404.
+    def __init__(self, *args, immutable: bool = False, fetch_missing=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.immutable = immutable
+        self.fetch_missing = fetch_missing
+
+    async def get_response(self, path, scope):
+        if self.fetch_missing is not None and self.lookup_path(path)[1] is None:
+            await run_in_threadpool(self.fetch_missing, path)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        headers = {"Cache-Control": self._cache_control(scope)}
+
+        media_type = None
+        accepted = request_headers.get("accept-encoding", "")
+        if str(full_path).endswith(COMPRESSIBLE_EXTENSIONS):
+            headers["Vary"] = "Accept-Encoding"
+            for encoding, suffix, _ in _encoders():
+                if encoding not in accepted:
+                    continue
+                compressed_path = f"{full_path}{suffix}"
+                try:
+                    compressed_stat = os.stat(compressed_path)
+                except OSError:
+                    continue
+                if compressed_stat.st_mtime < stat_result.st_mtime:
+                    # Stale, the source changed after compressing
+                    continue
+                media_type = mimetypes.guess_type(str(full_path))[0]
+                headers["Content-Encoding"] = encoding
+                full_path, stat_result = compressed_path, compressed_stat
+                break
+
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result,
+                                media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _cache_control(self, scope) -> str:
+        if self.immutable:
+            return IMMUTABLE_CACHE
+        query = scope.get("query_string", b"").decode()
+        return IMMUTABLE_CACHE if re.search(r"(^|&)v=", query) else REVALIDATE_CACHE
+
+
+class AssetVersions:
+    # Content hashes for files under a static directory, used to version the
+    # /static URLs referenced from HTML pages.
+    ASSET_PATTERN = re.compile(r'(src|href)="(/static/[^"?#]+)"')
+
+    def __init__(self, directory: str, url_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def version(self, url: str) -> str:
+        path = os.path.join(self.directory, url[len(self.url_prefix):].lstrip("/"))
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._hashes.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        hash_md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hash_md5.update(chunk)
+        digest = hash_md5.hexdigest()[:12]
+        with self._lock:
+            self._hashes[path] = (mtime, digest)
+        return digest
+
+    def url(self, url: str) -> str:
+        try:
+            return f"{url}?v={self.version(url)}"
+        except OSError:
+            return url
+
+    def render_html(self, page_path: str) -> str:
+        # Page HTML with every local asset reference versioned
+        with open(page_path, "r", encoding="utf-8") as f:
+            html = f.read()
+        return self.ASSET_PATTERN.sub(lambda m: f'{m.group(1)}="{self.url(m.group(2))}"', html)
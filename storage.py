@@ -0,0 +1,660 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, List, Dict
+
+from metrics import timed
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: FileLock then only coordinates threads of one process
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    md5 TEXT PRIMARY KEY,
+    hidden INTEGER NOT NULL DEFAULT 0,
+    rarity TEXT,
+    created_at INTEGER,
+    data TEXT NOT NULL,
+    name TEXT,
+    rarity_rank INTEGER,
+    phash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_cards_hidden ON cards(hidden);
+CREATE INDEX IF NOT EXISTS idx_cards_rarity ON cards(rarity);
+CREATE INDEX IF NOT EXISTS idx_cards_created_at ON cards(created_at);
+
+CREATE TABLE IF NOT EXISTS packs (
+    id TEXT PRIMARY KEY,
+    status TEXT,
+    created_at INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_packs_status ON packs(status);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Used for sorting by rarity
+RARITY_RANK = {"N": 1, "R": 2, "SR": 3, "SSR": 4, "UR": 5}
+
+# Library sort orders: keyset columns (also the cursor contents) and direction
+CARD_SORTS = {
+    "date-desc": (["created_at", "md5"], "DESC"),
+    "date-asc": (["created_at", "md5"], "ASC"),
+    "rarity-desc": (["rarity_rank", "created_at", "md5"], "DESC"),
+    "rarity-asc": (["rarity_rank", "created_at", "md5"], "ASC"),
+}
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that isn't a cursor we handed out
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def _card_sort_key(card, columns):
+    fields = {
+        "created_at": card.get("created_at", 0),
+        "md5": card["md5"],
+        "rarity_rank": RARITY_RANK.get(card.get("rarity"), 0),
+    }
+    return [fields[column] for column in columns]
+
+
+def read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    # Write to a temp file and rename over the target, so readers and crashes
+    # see either the old or the new file, never a half-written one
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class FileLock:
+    # Reentrant lock shared by the threads of this process and, through flock on
+    # `path`, by other processes (e.g. several uvicorn workers)
+    def __init__(self, path: str):
+        self.path = path
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._rlock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._file = open(self.path, "a")
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                self._rlock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._rlock.release()
+
+
+class CachedJSONFile:
+    # A JSON file parsed once per change. Every get() stats the file, so writes
+    # from other processes are picked up too; invalidate() covers writes whose
+    # stat looks unchanged. derive(data) builds state that is kept per version.
+    def __init__(self, path: str, derive=None):
+        self.path = path
+        self.derive = derive
+        # Held across read-update-write, also between worker processes
+        self.write_lock = FileLock(path + ".lock")
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._data = None
+        self._derived = None
+        self.version = 0
+
+    def get(self) -> Dict:
+        # Shared between callers, treat it as read-only
+        return self._load()[0]
+
+    def derived(self):
+        return self._load()[1]
+
+    def invalidate(self):
+        with self._lock:
+            self._stamp = None
+
+    def update(self, changes: Dict):
+        # Merges changes into the file
+        with self.write_lock:
+            # Straight from disk, the cache may not have seen another worker's write yet
+            data = read_json(self.path)
+            data.update(changes)
+            write_json(self.path, data)
+            self.invalidate()
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            stamp = "missing"
+        with self._lock:
+            if stamp != self._stamp:
+                data = read_json(self.path)
+                self._derived = self.derive(data) if self.derive else None
+                self._data = data
+                self._stamp = stamp
+                self.version += 1
+            return self._data, self._derived
+
+
+class SQLiteDatabase:
+    # Per-thread WAL connections plus a write transaction helper
+    schema = ""
+
+    def __init__(self, db_path: str = "cardgen.db"):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._open_lock = threading.Lock()
+        self._opened = False
+
+    def open(self):
+        # Creates the tables and runs migrations. The app does this at startup;
+        # otherwise the first query does, so constructing one touches no file.
+        with self._open_lock:
+            if self._opened:
+                return
+            conn = self._thread_conn()
+            conn.executescript(self.schema)
+            self.migrate(conn)
+            self._opened = True
+
+    def migrate(self, conn: sqlite3.Connection):
+        # Brings tables created by older versions up to date
+        pass
+
+    @staticmethod
+    def _add_column(conn, table, column, declaration) -> bool:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column in columns:
+            return False
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+
+    def _conn(self) -> sqlite3.Connection:
+        if not self._opened:
+            self.open()
+        return self._thread_conn()
+
+    def _thread_conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, and both the
+        # request handlers and background tasks run on worker threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        # Nested calls join the outer transaction
+        conn = self._conn()
+        if getattr(self._local, "in_tx", False):
+            yield conn
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.in_tx = True
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.in_tx = False
+
+
+class SQLiteStore(SQLiteDatabase):
+    # Cards and packs keyed by md5 / pack id. The full record lives in `data`,
+    # the other columns are copies of the fields we filter and sort on.
+    schema = SCHEMA
+
+    def migrate(self, conn):
+        added_name = self._add_column(conn, "cards", "name", "TEXT")
+        added_rank = self._add_column(conn, "cards", "rarity_rank", "INTEGER")
+        added_phash = self._add_column(conn, "cards", "phash", "TEXT")
+        if added_name or added_rank or added_phash:
+            with self._tx() as conn:
+                for row in conn.execute("SELECT data FROM cards").fetchall():
+                    card = json.loads(row[0])
+                    conn.execute(
+                        "UPDATE cards SET name = ?, rarity_rank = ?, phash = ? WHERE md5 = ?",
+                        (card.get("name"), RARITY_RANK.get(card.get("rarity"), 0), card.get("phash"), card["md5"]),
+                    )
+        conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_cards_visible_date ON cards(hidden, created_at, md5);
+            CREATE INDEX IF NOT EXISTS idx_cards_visible_rank ON cards(hidden, rarity_rank, created_at, md5);
+        """)
+
+    def atomic(self):
+        # Groups reads and writes into one write transaction, e.g.
+        #   with store.atomic(): card = store.get_card(md5); ...; store.put_card(card)
+        return self._tx()
+
+    # Cards
+    def get_card(self, md5: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM cards WHERE md5 = ?", (md5,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_card(self, card: Dict):
+        self.put_cards([card])
+
+    # Every card and pack write is timed as the "persistence" stage
+    @timed("persistence")
+    def put_cards(self, cards: List[Dict]):
+        with self._tx() as conn:
+            conn.executemany(
+                "INSERT INTO cards (md5, hidden, rarity, created_at, data, name, rarity_rank, phash) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(md5) DO UPDATE SET hidden = excluded.hidden, rarity = excluded.rarity, "
+                "created_at = excluded.created_at, data = excluded.data, name = excluded.name, "
+                "rarity_rank = excluded.rarity_rank, phash = excluded.phash",
+                [self._card_row(card) for card in cards],
+            )
+            self._touch_cards(conn)
+
+    def query_cards(self, rarity: Optional[str] = None, search: Optional[str] = None, sort: str = "date-desc",
+                    limit: Optional[int] = None, cursor: Optional[str] = None):
+        # Visible cards in library order. Returns (cards, next_cursor).
+        columns, direction = CARD_SORTS[sort]
+        where = ["hidden = 0"]
+        params = []
+        if rarity:
+            where.append("rarity = ?")
+            params.append(rarity)
+        if search:
+            where.append("name LIKE ? ESCAPE '\\'")
+            escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        if cursor:
+            values = decode_cursor(cursor)
+            if len(values) != len(columns):
+                raise ValueError("Invalid cursor")
+            op = "<" if direction == "DESC" else ">"
+            where.append(f"({', '.join(columns)}) {op} ({', '.join('?' * len(columns))})")
+            params.extend(values)
+
+        order = ", ".join(f"{column} {direction}" for column in columns)
+        sql = f"SELECT data FROM cards WHERE {' AND '.join(where)} ORDER BY {order}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+
+        cards = [json.loads(row[0]) for row in self._conn().execute(sql, params)]
+        next_cursor = None
+        if limit and len(cards) > limit:
+            cards = cards[:limit]
+            next_cursor = encode_cursor(_card_sort_key(cards[-1], columns))
+        return cards, next_cursor
+
+    def card_phashes(self, since: int = 0) -> List[tuple]:
+        # (md5, phash) of cards created at or after `since`, for the near-duplicate index
+        return self._conn().execute(
+            "SELECT md5, phash FROM cards WHERE phash IS NOT NULL AND created_at >= ?", (since,)
+        ).fetchall()
+
+    def cards_version(self):
+        # (version, modified_at) of the card table, for HTTP validators
+        rows = dict(self._conn().execute(
+            "SELECT key, value FROM meta WHERE key IN ('cards_version', 'cards_modified_at')"
+        ).fetchall())
+        return rows.get("cards_version", "0"), float(rows.get("cards_modified_at", 0))
+
+    @staticmethod
+    def _touch_cards(conn):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('cards_version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('cards_modified_at', ?)",
+            (str(time.time()),),
+        )
+
+    def list_cards(self, include_hidden: bool = False) -> List[Dict]:
+        sql = "SELECT data FROM cards"
+        if not include_hidden:
+            sql += " WHERE hidden = 0"
+        sql += " ORDER BY created_at, rowid"
+        return [json.loads(row[0]) for row in self._conn().execute(sql)]
+
+    def load_cards(self) -> Dict[str, Dict]:
+        return {card["md5"]: card for card in self.list_cards(include_hidden=True)}
+
+    @staticmethod
+    def _card_row(card):
+        return (
+            card["md5"],
+            1 if card.get("hidden", False) else 0,
+            card.get("rarity"),
+            card.get("created_at", 0),
+            json.dumps(card, ensure_ascii=False),
+            card.get("name"),
+            RARITY_RANK.get(card.get("rarity"), 0),
+            card.get("phash"),
+        )
+
+    # Packs
+    def get_pack(self, pack_id: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM packs WHERE id = ?", (pack_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_pack(self, pack: Dict):
+        self.put_packs([pack])
+
+    @timed("persistence")
+    def put_packs(self, packs: List[Dict]):
+        with self._tx() as conn:
+            conn.executemany(
+                "INSERT INTO packs (id, status, created_at, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET status = excluded.status, "
+                "created_at = excluded.created_at, data = excluded.data",
+                [self._pack_row(pack) for pack in packs],
+            )
+
+    def list_packs(self, exclude_status: Optional[str] = None) -> List[Dict]:
+        conn = self._conn()
+        if exclude_status is None:
+            rows = conn.execute("SELECT data FROM packs ORDER BY created_at DESC")
+        else:
+            rows = conn.execute(
+                "SELECT data FROM packs WHERE status != ? ORDER BY created_at DESC",
+                (exclude_status,),
+            )
+        return [json.loads(row[0]) for row in rows]
+
+    def load_packs(self) -> Dict[str, Dict]:
+        return {pack["id"]: pack for pack in self.list_packs()}
+
+    @staticmethod
+    def _pack_row(pack):
+        return (
+            pack["id"],
+            pack.get("status"),
+            pack.get("created_at", 0),
+            json.dumps(pack, ensure_ascii=False),
+        )
+
+    # JSON compatibility
+    def import_json(self, cards_path: str, packs_path: str):
+        # One-time migration from the old cards.json / packs.json files
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone()
+        if row:
+            return
+
+        cards = read_json(cards_path)
+        packs = read_json(packs_path)
+        for md5, card in cards.items():
+            card.setdefault("md5", md5)
+        for pack_id, pack in packs.items():
+            pack.setdefault("id", pack_id)
+
+        with self._tx() as conn:
+            # Workers starting together all get past the first check; only one imports
+            if conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone():
+                return
+            conn.executemany(
+                "INSERT OR IGNORE INTO cards (md5, hidden, rarity, created_at, data, name, rarity_rank, phash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._card_row(card) for card in cards.values()],
+            )
+            self._touch_cards(conn)
+            conn.executemany(
+                "INSERT OR IGNORE INTO packs (id, status, created_at, data) VALUES (?, ?, ?, ?)",
+                [self._pack_row(pack) for pack in packs.values()],
+            )
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('json_imported', '1')")
+
+        if cards or packs:
+            print(f"Imported {len(cards)} cards and {len(packs)} packs from JSON")
+
+    def export_json(self, cards_path: str, packs_path: str):
+        write_json(cards_path, self.load_cards())
+        write_json(packs_path, self.load_packs())
+
+
+class JSONStore:
+    # The original whole-file storage, same interface as SQLiteStore
+    def __init__(self, cards_path: str = "cards.json", packs_path: str = "packs.json"):
+        self.cards_path = cards_path
+        self.packs_path = packs_path
+        # Every read-modify-write of either file happens under this lock
+        self._lock = FileLock(cards_path + ".lock")
+
+    def atomic(self):
+        return self._lock
+
+    def get_card(self, md5):
+        return self.load_cards().get(md5)
+
+    def put_card(self, card):
+        self.put_cards([card])
+
+    @timed("persistence")
+    def put_cards(self, cards):
+        with self._lock:
+            all_cards = self.load_cards()
+            for card in cards:
+                all_cards[card["md5"]] = card
+            self.save_cards(all_cards)
+
+    def list_cards(self, include_hidden=False):
+        cards = list(self.load_cards().values())
+        if not include_hidden:
+            cards = [c for c in cards if not c.get("hidden", False)]
+        return cards
+
+    def query_cards(self, rarity=None, search=None, sort="date-desc", limit=None, cursor=None):
+        columns, direction = CARD_SORTS[sort]
+        descending = direction == "DESC"
+        cards = self.list_cards()
+        if rarity:
+            cards = [c for c in cards if c.get("rarity") == rarity]
+        if search:
+            cards = [c for c in cards if search.lower() in (c.get("name") or "").lower()]
+        cards.sort(key=lambda c: _card_sort_key(c, columns), reverse=descending)
+        if cursor:
+            values = decode_cursor(cursor)
+            if len(values) != len(columns):
+                raise ValueError("Invalid cursor")
+            cards = [c for c in cards if (_card_sort_key(c, columns) < values if descending else _card_sort_key(c, columns) > values)]
+
+        next_cursor = None
+        if limit and len(cards) > limit:
+            cards = cards[:limit]
+            next_cursor = encode_cursor(_card_sort_key(cards[-1], columns))
+        return cards, next_cursor
+
+    def card_phashes(self, since=0):
+        return [(c["md5"], c["phash"]) for c in self.load_cards().values()
+                if c.get("phash") and c.get("created_at", 0) >= since]
+
+    def cards_version(self):
+        if not os.path.exists(self.cards_path):
+            return "0", 0.0
+        stat = os.stat(self.cards_path)
+        return str(stat.st_mtime_ns), stat.st_mtime
+
+    def load_cards(self):
+        return read_json(self.cards_path)
+
+    def save_cards(self, cards):
+        with self._lock:
+            write_json(self.cards_path, cards)
+
+    def get_pack(self, pack_id):
+        return self.load_packs().get(pack_id)
+
+    def put_pack(self, pack):
+        self.put_packs([pack])
+
+    @timed("persistence")
+    def put_packs(self, packs):
+        with self._lock:
+            all_packs = self.load_packs()
+            for pack in packs:
+                all_packs[pack["id"]] = pack
+            self.save_packs(all_packs)
+
+    def list_packs(self, exclude_status=None):
+        packs = [p for p in self.load_packs().values() if exclude_status is None or p.get("status") != exclude_status]
+        packs.sort(key=lambda x: x.get("created_at", 0), reverse=True)
+        return packs
+
+    def load_packs(self):
+        return read_json(self.packs_path)
+
+    def save_packs(self, packs):
+        with self._lock:
+            write_json(self.packs_path, packs)
+
+    def import_json(self, cards_path, packs_path):
+        pass
+
+    def export_json(self, cards_path, packs_path):
+        write_json(cards_path, self.load_cards())
+        write_json(packs_path, self.load_packs())
+
+
+SETTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+"""
+
+
+class SQLiteSettings(SQLiteDatabase):
+    # Same interface as CachedJSONFile, for settings kept in the shared
+    # database. The JSON is parsed again only when the version row changes.
+    schema = SETTINGS_SCHEMA
+
+    def __init__(self, db_path: str = "cardgen.db", derive=None, import_path: Optional[str] = None):
+        self.derive = derive
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = None
+        self._derived = None
+        self.version = 0
+        self.import_path = import_path
+        super().__init__(db_path)
+
+    def migrate(self, conn):
+        # The first process to open the database starts from settings.json
+        if self.import_path and os.path.exists(self.import_path):
+            conn.execute(
+                "INSERT OR IGNORE INTO settings (id, data, version) VALUES (1, ?, 1)",
+                (json.dumps(read_json(self.import_path), ensure_ascii=False),),
+            )
+
+    def get(self) -> Dict:
+        return self._load()[0]
+
+    def derived(self):
+        return self._load()[1]
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def update(self, changes: Dict):
+        with self._tx() as conn:
+            row = conn.execute("SELECT data FROM settings WHERE id = 1").fetchone()
+            data = json.loads(row[0]) if row else {}
+            data.update(changes)
+            conn.execute(
+                "INSERT INTO settings (id, data, version) VALUES (1, ?, 1) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, version = version + 1",
+                (json.dumps(data, ensure_ascii=False),),
+            )
+        self.invalidate()
+
+    def _load(self):
+        row = self._conn().execute("SELECT version FROM settings WHERE id = 1").fetchone()
+        version = row[0] if row else 0
+        with self._lock:
+            if version != self._version:
+                row = self._conn().execute("SELECT data FROM settings WHERE id = 1").fetchone()
+                data = json.loads(row[0]) if row else {}
+                self._derived = self.derive(data) if self.derive else None
+                self._data = data
+                self._version = version
+                self.version += 1
+            return self._data, self._derived
+
+
+def open_store(backend: str = "sqlite", db_path: str = "cardgen.db", cards_path: str = "cards.json", packs_path: str = "packs.json"):
+    if backend == "json":
+        return JSONStore(cards_path, packs_path)
+    if backend == "sqlite":
+        return SQLiteStore(db_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+if __name__ == "__main__":
+    # python storage.py export [cards.json] [packs.json]
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print("usage: python storage.py export [cards.json] [packs.json]")
+        sys.exit(1)
+
+    store = SQLiteStore(os.getenv("CARDGEN_DB", "cardgen.db"))
+    cards_out = sys.argv[2] if len(sys.argv) > 2 else "cards.json"
+    packs_out = sys.argv[3] if len(sys.argv) > 3 else "packs.json"
+    store.export_json(cards_out, packs_out)
+    print(f"Exported to {cards_out} and {packs_out}")
@@ -0,0 +1,298 @@
+# Stress test for concurrent writes: settings POSTs, pack opens and card back
+# rebinding hammer one app at once, pack opens race the pack worker, and
+# several processes update the same JSON files or work one SQLite job queue.
+# No update may be lost and no temp file may be left behind.
+#
+#   python -m pytest -q tests/test_concurrency.py
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from jobs import JobQueue, JobWorkerPool  # noqa: E402
+from storage import CachedJSONFile, JSONStore, SQLiteStore, read_json  # noqa: E402
+
+THREADS = 8
+ROUNDS = 10
+PROCESSES = 6
+PROCESS_ROUNDS = 40
+PACKS = 3
+PACK_SIZE = 10
+
+
+def make_image(seed):
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", (96, 96), (seed * 37 % 256, seed * 91 % 256, seed * 53 % 256))
+    ImageDraw.Draw(img).rectangle((seed % 48, 10, seed % 48 + 40, 70), fill=(255, 255, 255))
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def temp_files(root):
+    return [os.path.join(d, f) for d, _, files in os.walk(root) for f in files if f.endswith(".tmp")]
+
+
+def run_threads(target, count):
+    errors = []
+
+    def guarded(index):
+        try:
+            target(index)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=guarded, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+@pytest.fixture
+def app_module(tmp_path):
+    # app.py works relative to the current directory and reads its config at import
+    shutil.copytree(os.path.join(REPO_DIR, "static"), tmp_path / "static")
+    old_cwd = os.getcwd()
+    old_env = {key: os.environ.get(key) for key in ("USE_STUB", "NEAR_DUP_MODE", "STORAGE_BACKEND")}
+    os.chdir(tmp_path)
+    os.environ.update(USE_STUB="true", NEAR_DUP_MODE="off", STORAGE_BACKEND="sqlite")
+    sys.modules.pop("app", None)
+    try:
+        import app
+        yield app
+    finally:
+        sys.modules.pop("app", None)
+        os.chdir(old_cwd)
+        for key, value in old_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def test_concurrent_endpoints_keep_every_update(app_module, tmp_path):
+    from fastapi.testclient import TestClient
+
+    with TestClient(app_module.app) as client:
+        images = [make_image(i) for i in range(THREADS)]
+        md5s = []
+        for i, image in enumerate(images):
+            response = client.post("/api/generate", files={"file": (f"card{i}.png", image, "image/png")})
+            assert response.status_code == 200, response.text
+            md5s.append(response.json()["md5"])
+
+        # One unopened pack per card, as the pack worker leaves them
+        store = app_module.store
+        for i, md5 in enumerate(md5s):
+            card = store.get_card(md5)
+            card["hidden"] = True
+            store.put_card(card)
+            store.put_pack({"id": f"pack{i}", "status": "ready", "cards": [md5], "created_at": i})
+
+        def settings_writer(index):
+            for i in range(ROUNDS):
+                response = client.post("/api/settings", json={f"stress_{index}_{i}": i})
+                assert response.status_code == 200, response.text
+
+        def pack_opener(index):
+            response = client.post(f"/api/open-pack/pack{index}")
+            assert response.status_code == 200, response.text
+
+        def rebinder(index):
+            # Re-uploading an existing image with a card back rebinds it
+            for i in range(ROUNDS):
+                response = client.post(
+                    "/api/generate",
+                    files={"file": (f"card{index}.png", images[index], "image/png")},
+                    data={"card_back": f"/static/card_backs/back-{index}-{i}.png"}
+                )
+                assert response.status_code == 200, response.text
+
+        def worker(index):
+            [settings_writer, pack_opener, rebinder][index % 3](index // 3)
+
+        run_threads(worker, THREADS * 3)
+
+        settings = app_module.settings_cache.get()
+        for index in range(THREADS):
+            for i in range(ROUNDS):
+                assert settings.get(f"stress_{index}_{i}") == i
+        for index, md5 in enumerate(md5s):
+            card = store.get_card(md5)
+            assert card["hidden"] is False
+            assert card["card_back"] == f"/static/card_backs/back-{index}-{ROUNDS - 1}.png"
+            assert store.get_pack(f"pack{index}")["status"] == "opened"
+
+    assert temp_files(tmp_path) == []
+
+
+def test_open_pack_races_the_last_job(app_module, tmp_path):
+    # Openers poll each pack from the moment it is queued, so the first open
+    # that gets through lands right after the last job finalizes the pack
+    from fastapi.testclient import TestClient
+
+    with TestClient(app_module.app) as client:
+        files = [("files", (f"pack{i}.png", make_image(100 + i), "image/png")) for i in range(PACKS * PACK_SIZE)]
+        response = client.post("/api/upload-packs", files=files)
+        assert response.status_code == 200, response.text
+        pack_ids = response.json()["pack_ids"]
+        assert len(pack_ids) == PACKS
+        first_opens = {}
+
+        def opener(index):
+            pack_id = pack_ids[index % PACKS]
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline:
+                response = client.post(f"/api/open-pack/{pack_id}")
+                if response.status_code == 200:
+                    first_opens.setdefault(pack_id, [card["md5"] for card in response.json()])
+                    return
+                assert response.status_code == 400, response.text
+            raise AssertionError(f"pack {pack_id} never became ready")
+
+        run_threads(opener, PACKS * 3)
+
+        store = app_module.store
+        for pack_id in pack_ids:
+            pack = store.get_pack(pack_id)
+            assert pack["status"] == "opened"
+            assert len(pack["cards"]) == PACK_SIZE
+            assert first_opens[pack_id] == pack["cards"]
+            assert all(store.get_card(md5)["hidden"] is False for md5 in pack["cards"])
+
+    assert temp_files(tmp_path) == []
+
+
+def bump_settings(path, worker):
+    settings = CachedJSONFile(path)
+    for i in range(PROCESS_ROUNDS):
+        # A shared counter needs the lock across read and write; plain keys do not
+        with settings.write_lock:
+            settings.update({"counter": read_json(path).get("counter", 0) + 1})
+        settings.update({f"worker_{worker}_{i}": i})
+
+
+def bump_store(cards_path, packs_path, worker):
+    store = JSONStore(cards_path, packs_path)
+    for i in range(PROCESS_ROUNDS):
+        store.put_cards([{"md5": f"{worker}-{i}-{uuid.uuid4().hex}", "hidden": False, "created_at": i}])
+        with store.atomic():
+            counter = store.get_card("counter")
+            counter["count"] += 1
+            store.put_card(counter)
+
+
+def work_jobs(db_path, log_dir, worker):
+    # One "host": its own worker pool on the shared database, finalizing packs
+    # the way app.finalize_pack does, and logging what it did
+    store, queue = SQLiteStore(db_path), JobQueue(db_path)
+    log_lock = threading.Lock()
+    log = open(os.path.join(log_dir, f"worker{worker}.log"), "a")
+
+    def write(line):
+        with log_lock:
+            log.write(line + "\n")
+            log.flush()
+
+    def handle(job):
+        md5 = f"{job['pack_id']}-{job['position']}"
+        time.sleep(0.05) # Long enough for the other processes to join in
+        store.put_card({"md5": md5, "hidden": True, "created_at": job["position"]})
+        write(f"job {job['id']}")
+        return md5
+
+    def finalize(pack_id):
+        results = queue.pack_results(pack_id)
+        with store.atomic():
+            pack = store.get_pack(pack_id)
+            if pack["status"] != "processing":
+                return
+            pack["status"] = "ready"
+            pack["cards"] = results
+            store.put_pack(pack)
+        write(f"pack {pack_id}")
+
+    pool = JobWorkerPool(queue, handle, finalize, workers=4, poll_interval=0.05)
+    pool.start()
+    while queue.depth():
+        time.sleep(0.05)
+    pool.stop()
+    log.close()
+
+
+def run_processes(target, *args):
+    # spawn: the children start clean instead of inheriting pytest's threads
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=args + (worker,)) for worker in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(120)
+    assert [process.exitcode for process in processes] == [0] * PROCESSES
+
+
+def test_processes_share_settings_file(tmp_path):
+    path = str(tmp_path / "settings.json")
+    run_processes(bump_settings, path)
+
+    data = read_json(path)
+    assert data["counter"] == PROCESSES * PROCESS_ROUNDS
+    for worker in range(PROCESSES):
+        for i in range(PROCESS_ROUNDS):
+            assert data[f"worker_{worker}_{i}"] == i
+    assert temp_files(tmp_path) == []
+
+
+def test_processes_share_json_store(tmp_path):
+    cards_path, packs_path = str(tmp_path / "cards.json"), str(tmp_path / "packs.json")
+    JSONStore(cards_path, packs_path).put_card({"md5": "counter", "count": 0, "hidden": True, "created_at": 0})
+    run_processes(bump_store, cards_path, packs_path)
+
+    store = JSONStore(cards_path, packs_path)
+    assert store.get_card("counter")["count"] == PROCESSES * PROCESS_ROUNDS
+    assert len(store.list_cards()) == PROCESSES * PROCESS_ROUNDS
+    assert temp_files(tmp_path) == []
+
+
+def test_processes_share_sqlite_job_queue(tmp_path):
+    db_path = str(tmp_path / "cardgen.db")
+    store, queue = SQLiteStore(db_path), JobQueue(db_path)
+    pack_ids = [f"pack{i}" for i in range(PROCESSES)]
+    store.put_packs([{"id": pack_id, "status": "processing", "cards": [], "created_at": 0} for pack_id in pack_ids])
+    queue.enqueue([
+        {"pack_id": pack_id, "position": position, "file_path": f"{pack_id}-{position}.png"}
+        for pack_id in pack_ids for position in range(PACK_SIZE)
+    ])
+    run_processes(work_jobs, db_path, str(tmp_path))
+
+    lines = []
+    busy_workers = 0
+    for worker in range(PROCESSES):
+        with open(tmp_path / f"worker{worker}.log") as f:
+            worker_lines = f.read().split()[1::2]
+        busy_workers += bool(worker_lines)
+        lines += worker_lines
+    assert busy_workers > 1
+    done_jobs = [line for line in lines if not line.startswith("pack")]
+    finalized = [line for line in lines if line.startswith("pack")]
+    # Every job ran exactly once and every pack was finalized exactly once
+    assert sorted(done_jobs, key=int) == [str(i) for i in range(1, PROCESSES * PACK_SIZE + 1)]
+    assert sorted(finalized) == pack_ids
+    for pack_id in pack_ids:
+        pack = store.get_pack(pack_id)
+        assert pack["status"] == "ready"
+        assert pack["cards"] == [f"{pack_id}-{position}" for position in range(PACK_SIZE)]
+    assert len(store.list_cards(include_hidden=True)) == PROCESSES * PACK_SIZE
@@ -0,0 +1,144 @@
+# Circuit breaker and retry behaviour of VLMService against a local stub server:
+# open -> half-open -> closed, failed trials reopening it, and Retry-After caps.
+#
+#   python -m pytest -q tests/test_vlm_breaker.py
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from vlm import VLMService, VLMUnavailableError  # noqa: E402
+
+RESET_TIMEOUT = 0.2
+
+
+class StubVLM(ThreadingHTTPServer):
+    # Answers every POST according to `mode`: "ok", "error" (500), "bad_json"
+    # or "busy" (503 with Retry-After: 3600)
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.mode = "ok"
+        self.posts = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.posts += 1
+        mode = self.server.mode
+        if mode == "error":
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if mode == "busy":
+            self.send_response(503)
+            self.send_header("Retry-After", "3600")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"not json" if mode == "bad_json" else json.dumps({"choices": [{"message": {"content": "R"}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub():
+    server = StubVLM()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_service(stub, **kwargs):
+    options = dict(
+        api_base=f"http://127.0.0.1:{stub.server_port}",
+        use_stub=False,
+        max_retries=0,
+        breaker_threshold=2,
+        breaker_reset_timeout=RESET_TIMEOUT,
+        read_timeout=1.0,
+    )
+    options.update(kwargs)
+    return VLMService(**options)
+
+
+def post(service):
+    return service._post_with_retries("/v1/chat/completions", {})
+
+
+def test_breaker_opens_then_half_open_trial_closes_it(stub):
+    service = make_service(stub)
+    breaker = service.endpoints[0].breaker
+    stub.mode = "error"
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            post(service)
+    assert breaker.state == "open"
+
+    # Open: rejected without reaching the server
+    posts = stub.posts
+    with pytest.raises(VLMUnavailableError):
+        post(service)
+    assert stub.posts == posts
+
+    time.sleep(RESET_TIMEOUT + 0.05)
+    assert breaker.state == "half-open"
+    stub.mode = "ok"
+    assert post(service)["choices"][0]["message"]["content"] == "R"
+    assert breaker.state == "closed"
+    service.close()
+
+
+def test_failed_trial_reopens_instead_of_wedging(stub):
+    service = make_service(stub)
+    breaker = service.endpoints[0].breaker
+    stub.mode = "error"
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            post(service)
+
+    # A trial that fails outside the HTTP error path (a 200 with a broken body)
+    time.sleep(RESET_TIMEOUT + 0.05)
+    stub.mode = "bad_json"
+    with pytest.raises(ValueError):
+        post(service)
+    assert breaker.state == "open"
+    assert not breaker._trial_in_flight
+
+    time.sleep(RESET_TIMEOUT + 0.05)
+    stub.mode = "ok"
+    post(service)
+    assert breaker.state == "closed"
+    service.close()
+
+
+def test_retry_after_is_capped_at_the_read_timeout(stub):
+    service = make_service(stub, max_retries=1, breaker_threshold=10, read_timeout=0.3)
+    assert service._retry_delay(1, "3600") == 0.3
+    assert service._retry_delay(1, "0") == 0
+
+    stub.mode = "busy"
+    started = time.monotonic()
+    with pytest.raises(requests.HTTPError):
+        post(service)
+    assert time.monotonic() - started < 2
+    assert stub.posts == 2
+    service.close()
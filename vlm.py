@@ -1,11 +1,16 @@
 import base64
+import hashlib
+import json
 import os
 import random
-import requests
+import threading
 import time
-from typing import Optional, Dict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List
 from io import BytesIO
-from PIL import Image
+
+from metrics import span, timed, ANALYSIS_CACHE, STUB_FALLBACKS, VLM_CALL_SECONDS, VLM_ERRORS
 
 DEFAULT_PROMPTS = {
     "rarity": "Analyze this image and determine its rarity. Choose one from: N, R, SR, SSR, UR. Output only the rarity code (e.g., SSR).",
@@ -17,35 +22,322 @@ DEFAULT_PROMPTS = {
 
 DEFAULT_SINGLE_CALL_PROMPT = """Create a funny and creative name and ability description for a trading card based on this image. Name and Description should be in Chinese (Chinese). The description should be short (max 2 sentences)."""
 
+FIELDS = ["rarity", "name", "description", "atk", "def"]
+
+# Image preprocessing before it is sent to the model
+MAX_SIZE = 576
+JPEG_QUALITY = 85
+
+# Responses worth retrying: rate limiting and server-side errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def prompt_hash(prompts: Dict[str, str]) -> str:
+    # Stable digest of the prompt text behind an analysis, part of the cache key
+    return hashlib.sha256(json.dumps(prompts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+class PromptSet:
+    # The prompts for one version of the settings, merged and formatted once
+    def __init__(self, custom_prompts: Optional[Dict[str, str]] = None, single_call_mode: bool = False, single_call_prompt: str = ""):
+        self.single_call_mode = single_call_mode
+        self.single_call_text = None
+        if single_call_mode:
+            instruction = single_call_prompt if single_call_prompt.strip() else DEFAULT_SINGLE_CALL_PROMPT
+            self.prompts = {"single_call": instruction}
+            self.single_call_text = f"""
+            {instruction}
+
+            MANDATORY OUTPUT FORMAT:
+            You must analyze the image and return a JSON object with the following keys:
+            - "rarity": Choose one from [N, R, SR, SSR, UR] based on how epic the image looks.
+            - "name": The name of the card.
+            - "description": The ability text.
+            - "atk": Number 0-5000.
+            - "def": Number 0-5000.
+
+            Return ONLY the raw JSON string. Do not include markdown formatting like ```json.
+        """
+            self.batch_guidance = instruction
+        else:
+            # Merge defaults with custom prompts
+            self.prompts = DEFAULT_PROMPTS.copy()
+            if custom_prompts:
+                for key, value in custom_prompts.items():
+                    if value and value.strip():
+                        self.prompts[key] = value
+            self.batch_guidance = "\n".join(f'- "{field}": {self.prompts[field]}' for field in FIELDS)
+        self.hash = prompt_hash(self.prompts)
+
+class VLMUnavailableError(Exception):
+    pass
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures and rejects calls for
+    # `reset_timeout` seconds, then lets a single trial call through (half-open).
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+class Endpoint:
+    # One inference server: routing weight, health and request statistics
+    def __init__(self, url: str, weight: float = 1.0, breaker_threshold=5, breaker_reset_timeout=30.0):
+        self.url = url.rstrip('/')
+        self.weight = max(weight, 0.01)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout)
+        self.healthy = True # Set by active health checks
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency_ewma = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return self.healthy and self.breaker.state != "open"
+
+    def load(self) -> float:
+        return (self.outstanding + 1) / self.weight
+
+    def begin(self):
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def end(self, latency: float, error: Optional[str] = None):
+        with self._lock:
+            self.outstanding -= 1
+            if error:
+                self.errors += 1
+                self.last_error = error
+            else:
+                self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "url": self.url,
+                "weight": self.weight,
+                "healthy": self.healthy,
+                "circuit": self.breaker.state,
+                "outstanding": self.outstanding,
+                "requests": self.requests,
+                "errors": self.errors,
+                "latency_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+                "last_error": self.last_error
+            }
+
+def parse_endpoints(spec: str) -> List[Dict]:
+    # "http://a:8080|2,http://b:8080" -> [{"url": "http://a:8080", "weight": 2.0}, {"url": "http://b:8080", "weight": 1.0}]
+    endpoints = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, weight = entry.partition("|")
+        endpoints.append({"url": url.strip(), "weight": float(weight) if weight else 1.0})
+    return endpoints
+
 class VLMService:
-    def __init__(self, api_base="http://192.168.124.22:8080", api_key="sk-placeholder", model="vlm-model", use_stub=True):
-        self.api_base = api_base.rstrip('/')
+    def __init__(self, api_base="http://192.168.124.22:8080", api_key="sk-placeholder", model="vlm-model", use_stub=True, max_concurrency=5, image_cache_size=64,
+                 pool_size=10, connect_timeout=5.0, read_timeout=60.0, max_retries=2, retry_backoff=0.5,
+                 breaker_threshold=5, breaker_reset_timeout=30.0, endpoints: Optional[List[Dict]] = None,
+                 health_check_interval=0.0, result_cache=None, batch_size=1, batch_wait=0.5):
+        # `endpoints` ([{"url", "weight"}]) spreads requests over several servers;
+        # otherwise `api_base` is the only one.
+        if not endpoints:
+            endpoints = [{"url": api_base, "weight": 1.0}]
+        self.endpoints = [
+            Endpoint(e["url"], e.get("weight", 1.0), breaker_threshold, breaker_reset_timeout) for e in endpoints
+        ]
+        self.api_base = self.endpoints[0].url
         self.api_key = api_key
         self.model = model
         self.use_stub = use_stub
+        # One keep-alive session shared by all calls, created on first use
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.pool_size = pool_size
+        self._session_obj = None
+        self._session_lock = threading.Lock()
+        self._route_lock = threading.Lock()
+        self.health_check_interval = health_check_interval
+        self._health_thread = None
+        self._stopped = threading.Event()
+        # Caps the requests in flight to the VLM servers from this service, in
+        # every mode; _call_vlm holds a slot for the whole request
+        self.max_concurrency = max(1, max_concurrency)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        # Runs the per-field calls of multi-field analyses; the slots do the limiting
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="vlm")
+        # LRU of base64 payloads keyed by (md5, max size, quality)
+        self.image_cache_size = image_cache_size
+        # Optional persistent store of finished analyses (see analysis_cache.AnalysisCache)
+        self.result_cache = result_cache
+        # Concurrent analyses with the same prompts are grouped into one request of up
+        # to `batch_size` images; the first one waits at most `batch_wait` for company.
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self._open_batches = {}
+        self._batch_cond = threading.Condition()
+        self._image_cache = OrderedDict()
+        self._image_cache_lock = threading.Lock()
+
+    @property
+    def _session(self):
+        # requests is imported here so that importing this module stays cheap
+        if self._session_obj is None:
+            with self._session_lock:
+                if self._session_obj is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
 
-    def analyze_image(self, image_path: str, custom_prompts: Optional[Dict[str, str]] = None, single_call_mode: bool = False, single_call_prompt: str = "") -> Dict[str, str]:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=max(self.pool_size, len(self.endpoints)), pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    session.headers.update({
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {self.api_key}"
+                    })
+                    self._session_obj = session
+        return self._session_obj
+
+    def start(self):
+        # Background health checks, when configured
+        if self.health_check_interval > 0 and not self.use_stub and self._health_thread is None:
+            self._health_thread = threading.Thread(target=self._health_check_loop, name="vlm-health", daemon=True)
+            self._health_thread.start()
+
+    def warm_up(self):
+        # Opens a connection to every endpoint ahead of the first analysis
+        # without judging their health (that is the health checks' job)
+        import requests
+
+        if self.use_stub:
+            return
+        for endpoint in self.endpoints:
+            try:
+                # Reading the body hands the connection back to the pool
+                self._session.get(f"{endpoint.url}/v1/models", timeout=self.timeout[0]).content
+            except requests.RequestException as e:
+                print(f"VLM warm-up of {endpoint.url} failed: {e}")
+
+    def close(self):
+        self._stopped.set()
+        if self._health_thread is not None:
+            self._health_thread.join(self.timeout[0] + 1)
+            self._health_thread = None
+        self._executor.shutdown(wait=False)
+        with self._session_lock:
+            session, self._session_obj = self._session_obj, None
+        if session is not None:
+            session.close()
+
+    def analyze_image(self, image_path: str, custom_prompts: Optional[Dict[str, str]] = None, single_call_mode: bool = False, single_call_prompt: str = "", image_md5: Optional[str] = None, bypass_cache: bool = False, prompt_set: Optional[PromptSet] = None) -> Dict[str, str]:
+        # bypass_cache forces fresh model calls (a reroll); the new result still replaces the cached one.
+        # A prompt_set compiled ahead of time replaces the three prompt arguments.
         if self.use_stub:
+            return self._stub_analyze(image_path, simulate_delay=True)
+
+        if prompt_set is None:
+            prompt_set = PromptSet(custom_prompts, single_call_mode, single_call_prompt)
+
+        cache_key = None
+        if self.result_cache is not None and image_md5:
+            cache_key = (image_md5, prompt_set.hash, self.model, prompt_set.single_call_mode)
+            if bypass_cache:
+                ANALYSIS_CACHE.inc(result="bypass")
+            else:
+                try:
+                    cached = self.result_cache.get(*cache_key)
+                except Exception as e:
+                    print(f"Analysis cache read failed: {e}")
+                    cached = None
+                ANALYSIS_CACHE.inc(result="hit" if cached else "miss")
+                if cached:
+                    return cached
+
+        try:
+            # Encode once, every prompt below reuses the same payload
+            base64_image = self._get_encoded_image(image_path, image_md5)
+        except Exception as e:
+            print(f"Image preprocessing failed: {e}")
+            STUB_FALLBACKS.inc(reason="preprocess")
             return self._stub_analyze(image_path)
 
-        if single_call_mode:
-            return self._analyze_single_call(image_path, single_call_prompt)
-        
-        # Merge defaults with custom prompts
-        prompts = DEFAULT_PROMPTS.copy()
-        if custom_prompts:
-            for key, value in custom_prompts.items():
-                if value and value.strip():
-                    prompts[key] = value
+        result = None
+        if self.batch_size > 1:
+            result = self._analyze_batched(base64_image, prompt_set)
+        if result is None:
+            # Unbatched, or the batch answer for this image was unusable
+            if prompt_set.single_call_mode:
+                result = self._analyze_single_call(base64_image, prompt_set.single_call_text)
+            else:
+                result = self._analyze_fields(base64_image, prompt_set.prompts)
+
+        if result is None:
+            # Fallback results are never cached
+            STUB_FALLBACKS.inc(reason="vlm_error")
+            return self._stub_analyze(image_path)
+        if cache_key:
+            try:
+                self.result_cache.put(*cache_key, result)
+            except Exception as e:
+                print(f"Analysis cache write failed: {e}")
+        return result
 
+    def _analyze_fields(self, base64_image: str, prompts: Dict[str, str]) -> Optional[Dict[str, str]]:
         try:
-            # Separate calls as requested to handle smaller models better
-            rarity = self._call_vlm(image_path, prompts["rarity"])
-            name = self._call_vlm(image_path, prompts["name"])
-            description = self._call_vlm(image_path, prompts["description"])
-            atk = self._call_vlm(image_path, prompts["atk"])
-            def_ = self._call_vlm(image_path, prompts["def"])
-            
+            # Separate calls as requested to handle smaller models better.
+            # The prompts are independent, so they run concurrently.
+            futures = {field: self._executor.submit(self._call_vlm, base64_image, prompts[field], field) for field in FIELDS}
+            results = {field: future.result() for field, future in futures.items()}
+        except Exception as e:
+            print(f"VLM Analysis failed: {e}")
+            return None # Caller falls back to stub
+
+        with span("parse"):
+            rarity = results["rarity"]
+            name = results["name"]
+            description = results["description"]
+            atk = results["atk"]
+            def_ = results["def"]
+
             # Fallback if calls fail or return empty (basic error handling)
             if not rarity: rarity = "N"
             if not name: name = "Unknown Entity"
@@ -60,18 +352,66 @@ class VLMService:
                 "atk": self._clean_number(atk),
                 "def": self._clean_number(def_)
             }
+
+    def _analyze_single_call(self, base64_image: str, prompt: str) -> Optional[Dict[str, str]]:
+        try:
+            response_text = self._call_vlm(base64_image, prompt, "single_call")
+            with span("parse"):
+                return self._card_from_json(json.loads(self._strip_code_fence(response_text)))
         except Exception as e:
-            print(f"VLM Analysis failed: {e}")
-            return self._stub_analyze(image_path) # Fallback to stub on error
+            print(f"Single Call Analysis failed: {e}")
+            return None # Caller falls back to stub
+
+    def _analyze_batched(self, base64_image: str, prompt_set: PromptSet) -> Optional[Dict[str, str]]:
+        # The first caller for a prompt set opens a batch and sends it once it is
+        # full or batch_wait has passed; later callers join and wait for the result.
+        # Returns None when this image has to be analyzed on its own.
+        key = (prompt_set.hash, prompt_set.single_call_mode)
+        item = {"image": base64_image, "result": None, "done": threading.Event()}
+        with self._batch_cond:
+            batch = self._open_batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = []
+                self._open_batches[key] = batch
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                del self._open_batches[key]
+                self._batch_cond.notify_all()
+
+            if leader:
+                deadline = time.monotonic() + self.batch_wait
+                while self._open_batches.get(key) is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        del self._open_batches[key]
+                        break
+                    self._batch_cond.wait(remaining)
 
-    def _analyze_single_call(self, image_path: str, custom_instruction: str) -> Dict[str, str]:
-        instruction = custom_instruction if custom_instruction.strip() else DEFAULT_SINGLE_CALL_PROMPT
+        if not leader:
+            item["done"].wait()
+            return item["result"]
 
+        try:
+            if len(batch) > 1:
+                self._run_batch(batch, prompt_set)
+        finally:
+            for other in batch:
+                other["done"].set()
+        return item["result"]
+
+    def _run_batch(self, batch: List[Dict], prompt_set: PromptSet):
+        guidance = prompt_set.batch_guidance
         prompt = f"""
-            {instruction}
+            You are given {len(batch)} images, numbered 1 to {len(batch)} in the order they appear.
+            Create one trading card for each image.
+
+            {guidance}
 
             MANDATORY OUTPUT FORMAT:
-            You must analyze the image and return a JSON object with the following keys:
+            Return a JSON array with exactly {len(batch)} objects, one per image and in the same order.
+            Each object has the keys:
+            - "index": The image number (1 to {len(batch)}).
             - "rarity": Choose one from [N, R, SR, SSR, UR] based on how epic the image looks.
             - "name": The name of the card.
             - "description": The ability text.
@@ -82,30 +422,46 @@ class VLMService:
         """
 
         try:
-            response_text = self._call_vlm(image_path, prompt)
+            response_text = self._call_vlm([item["image"] for item in batch], prompt, "batch")
+            with span("parse"):
+                cards = json.loads(self._strip_code_fence(response_text))
+        except Exception as e:
+            print(f"Batch analysis of {len(batch)} images failed: {e}")
+            return
+        if not isinstance(cards, list):
+            print("Batch analysis returned no JSON array")
+            return
 
-            # Clean markdown code blocks if present
-            clean_content = response_text.strip()
-            if clean_content.startswith("```json"):
-                clean_content = clean_content[7:]
-            if clean_content.startswith("```"):
-                clean_content = clean_content[3:]
-            if clean_content.endswith("```"):
-                clean_content = clean_content[:-3]
+        for position, card_json in enumerate(cards):
+            if not isinstance(card_json, dict):
+                continue
+            index = card_json.get("index", position + 1)
+            if not isinstance(index, int) or not 1 <= index <= len(batch) or not card_json.get("name"):
+                continue
+            try:
+                batch[index - 1]["result"] = self._card_from_json(card_json)
+            except Exception:
+                continue
 
-            card_json = json.loads(clean_content.strip())
+    def _strip_code_fence(self, text: str) -> str:
+        # Clean markdown code blocks if present
+        clean_content = text.strip()
+        if clean_content.startswith("```json"):
+            clean_content = clean_content[7:]
+        if clean_content.startswith("```"):
+            clean_content = clean_content[3:]
+        if clean_content.endswith("```"):
+            clean_content = clean_content[:-3]
+        return clean_content.strip()
 
-            return {
-                "rarity": self._clean_rarity(card_json.get("rarity", "N")),
-                "name": card_json.get("name", "Unknown").strip(),
-                "description": card_json.get("description", "No Data").strip(),
-                "atk": self._clean_number(str(card_json.get("atk", "0"))),
-                "def": self._clean_number(str(card_json.get("def", "0")))
-            }
-        except Exception as e:
-            print(f"Single Call Analysis failed: {e}")
-            # Try fallback to stub or simple error return
-            return self._stub_analyze(image_path)
+    def _card_from_json(self, card_json: Dict) -> Dict[str, str]:
+        return {
+            "rarity": self._clean_rarity(card_json.get("rarity", "N")),
+            "name": card_json.get("name", "Unknown").strip(),
+            "description": card_json.get("description", "No Data").strip(),
+            "atk": self._clean_number(str(card_json.get("atk", "0"))),
+            "def": self._clean_number(str(card_json.get("def", "0")))
+        }
 
     def _clean_number(self, text: str) -> str:
         # Extract digits
@@ -120,8 +476,10 @@ class VLMService:
                 return r
         return "N"
 
-    def _stub_analyze(self, image_path: str) -> Dict[str, str]:
-        time.sleep(1.5) # Simulate network delay
+    def _stub_analyze(self, image_path: str, simulate_delay: bool = False) -> Dict[str, str]:
+        # Only stub mode simulates latency; fallbacks after a failed call return at once
+        if simulate_delay:
+            time.sleep(1.5) # Simulate network delay
         
         rarities = ["N", "R", "SR", "SSR", "UR"]
         names = [
@@ -151,9 +509,30 @@ class VLMService:
             "def": str(random.randint(0, 500) * 10)
         }
 
-    def _call_vlm(self, image_path: str, prompt: str) -> str:
+    def _get_encoded_image(self, image_path: str, image_md5: Optional[str] = None) -> str:
+        if not image_md5 or self.image_cache_size <= 0:
+            return self._encode_image(image_path)
+
+        key = (image_md5, MAX_SIZE, JPEG_QUALITY)
+        with self._image_cache_lock:
+            if key in self._image_cache:
+                self._image_cache.move_to_end(key)
+                return self._image_cache[key]
+
+        base64_image = self._encode_image(image_path)
+
+        with self._image_cache_lock:
+            self._image_cache[key] = base64_image
+            self._image_cache.move_to_end(key)
+            while len(self._image_cache) > self.image_cache_size:
+                self._image_cache.popitem(last=False)
+        return base64_image
+
+    @timed("image_encode")
+    def _encode_image(self, image_path: str) -> str:
+        from PIL import Image
+
         # Resize image logic
-        MAX_SIZE = 576
         with Image.open(image_path) as img:
             # Convert to RGB to handle PNGs with alpha channel if necessary for JPEG saving
             if img.mode in ('RGBA', 'P'):
@@ -167,9 +546,13 @@ class VLMService:
                 img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
             
             buffered = BytesIO()
-            img.save(buffered, format="JPEG", quality=85)
-            base64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
+            img.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+            return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
+    def _call_vlm(self, base64_image, prompt: str, label: str = "custom") -> str:
+        # base64_image may also be a list, for one request covering several images.
+        # label names the prompt in metrics (a field, "single_call" or "batch").
+        images = base64_image if isinstance(base64_image, list) else [base64_image]
         messages = [
             {
                 "role": "user",
@@ -177,9 +560,10 @@ class VLMService:
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": f"data:image/jpeg;base64,{image}"
                         }
-                    },
+                    } for image in images
+                ] + [
                     {
                         "type": "text",
                         "text": prompt
@@ -188,11 +572,6 @@ class VLMService:
             }
         ]
         
-        url = f"{self.api_base}/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
         payload = {
             "model": self.model,
             "messages": messages,
@@ -200,7 +579,107 @@ class VLMService:
             "max_tokens": 4096
         }
         
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        data = response.json()
+        started = time.perf_counter()
+        with self._slots, span("vlm_call"):
+            data = self._post_with_retries("/v1/chat/completions", payload)
+        VLM_CALL_SECONDS.observe(time.perf_counter() - started, prompt=label)
         return data["choices"][0]["message"]["content"]
+
+    def endpoint_stats(self) -> List[Dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def _pick_endpoint(self, tried) -> Optional[Endpoint]:
+        # Least outstanding requests relative to weight; endpoints already tried
+        # for this request are used only when nothing else is available.
+        with self._route_lock:
+            candidates = [e for e in self.endpoints if e.available()]
+            fresh = [e for e in candidates if e not in tried]
+            for endpoint in sorted(fresh or candidates, key=lambda e: e.load()):
+                if endpoint.breaker.allow():
+                    endpoint.begin()
+                    return endpoint
+        return None
+
+    def _post_with_retries(self, path: str, payload: Dict) -> Dict:
+        import requests
+
+        attempt = 0
+        tried = set()
+        while True:
+            endpoint = self._pick_endpoint(tried)
+            if endpoint is None:
+                VLM_ERRORS.inc(endpoint="none", kind="unavailable")
+                raise VLMUnavailableError("No healthy VLM endpoint available")
+            tried.add(endpoint)
+
+            url = f"{endpoint.url}{path}"
+            retry_after = None
+            started = time.monotonic()
+            try:
+                response = self._session.post(url, json=payload, timeout=self.timeout)
+                if response.status_code in RETRY_STATUS_CODES:
+                    retry_after = response.headers.get("Retry-After")
+                    raise requests.HTTPError(f"{response.status_code} from {url}", response=response)
+                response.raise_for_status()
+                data = response.json()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                endpoint.end(time.monotonic() - started, error=str(e))
+                if isinstance(e, requests.HTTPError):
+                    kind = f"http_{e.response.status_code}"
+                else:
+                    kind = "timeout" if isinstance(e, requests.Timeout) else "connection"
+                VLM_ERRORS.inc(endpoint=endpoint.url, kind=kind)
+                if isinstance(e, requests.HTTPError) and e.response.status_code not in RETRY_STATUS_CODES:
+                    # The backend answered, the request itself was rejected
+                    endpoint.breaker.record_success()
+                    raise
+                endpoint.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                # Another endpoint can take the retry straight away
+                if not any(e.available() and e not in tried for e in self.endpoints):
+                    time.sleep(self._retry_delay(attempt, retry_after))
+                continue
+            except BaseException as e:
+                endpoint.end(time.monotonic() - started, error=str(e))
+                VLM_ERRORS.inc(endpoint=endpoint.url, kind=type(e).__name__)
+                # Bad JSON, broken chunked bodies, ... still end a half-open trial
+                endpoint.breaker.record_failure()
+                raise
+
+            endpoint.end(time.monotonic() - started)
+            endpoint.breaker.record_success()
+            return data
+
+    def _health_check_loop(self):
+        # Until close(); a probe after it would open a new session
+        while not self._stopped.wait(self.health_check_interval):
+            for endpoint in self.endpoints:
+                if self._stopped.is_set():
+                    return
+                self._check_endpoint(endpoint)
+
+    def _check_endpoint(self, endpoint: Endpoint):
+        # Evicts endpoints that stop answering and re-admits them once they do
+        import requests
+
+        try:
+            response = self._session.get(f"{endpoint.url}/v1/models", timeout=self.timeout[0])
+            healthy = response.status_code < 500
+        except requests.RequestException:
+            healthy = False
+
+        if healthy and not endpoint.healthy:
+            print(f"VLM endpoint {endpoint.url} is healthy again")
+            endpoint.breaker.record_success()
+        elif not healthy and endpoint.healthy:
+            print(f"VLM endpoint {endpoint.url} failed its health check")
+        endpoint.healthy = healthy
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after and retry_after.isdigit():
+            # Never park a pool thread for longer than a request may take
+            return min(float(retry_after), self.timeout[1])
+        # Exponential backoff with full jitter
+        return random.uniform(0, self.retry_backoff * (2 ** (attempt - 1)))
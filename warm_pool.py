@@ -0,0 +1,147 @@
+import collections
+import threading
+import time
+import traceback
+from typing import Callable, Optional, Dict
+
+from storage import SQLiteDatabase
+
+POOL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS card_pool (
+    source TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (source, md5)
+);
+CREATE INDEX IF NOT EXISTS idx_card_pool_source ON card_pool(source, created_at);
+"""
+
+
+class PoolStore(SQLiteDatabase):
+    # Ready-to-reveal cards per source. The cards themselves live in the card
+    # store with hidden=True; this table only holds their md5s.
+    schema = POOL_SCHEMA
+
+    def add(self, source: str, md5: str):
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO card_pool (source, md5, created_at) VALUES (?, ?, ?)",
+                (source, md5, time.time()),
+            )
+
+    def take(self, source: str) -> Optional[str]:
+        # Oldest card first; each one is handed out exactly once, across processes too
+        with self._tx() as conn:
+            row = conn.execute(
+                "SELECT md5 FROM card_pool WHERE source = ? ORDER BY created_at LIMIT 1", (source,)
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute("DELETE FROM card_pool WHERE source = ? AND md5 = ?", (source, row[0]))
+        return row[0]
+
+    def depth(self, source: str) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM card_pool WHERE source = ?", (source,)).fetchone()[0]
+
+
+class WarmPool:
+    # Keeps `target` pre-generated cards for one source. produce() generates a
+    # hidden card and returns its md5 (None when it could not); `workers` threads
+    # call it whenever the pool is below target, at most once per `interval` seconds each.
+    def __init__(self, pool_store: PoolStore, source: str, produce: Callable[[], Optional[str]],
+                 target: int = 10, workers: int = 2, interval: float = 0.0, retry_delay: float = 5.0):
+        self.pool_store = pool_store
+        self.source = source
+        self.produce = produce
+        self.target = target
+        self.workers = max(1, workers)
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.hits = 0
+        self.misses = 0
+        self.produced = 0
+        self.failures = 0
+        self._recent = collections.deque() # Produce timestamps of the last minute
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        with self._lock:
+            if self._threads or self.target <= 0:
+                return
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"warm-pool-{self.source}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._wakeup.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+
+    def take(self) -> Optional[str]:
+        # md5 of a ready card, or None on a miss. Either way the pool refills.
+        self.start()
+        md5 = self.pool_store.take(self.source)
+        with self._lock:
+            if md5:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._wakeup.notify_all()
+        return md5
+
+    def stats(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            return {
+                "source": self.source,
+                "depth": self.pool_store.depth(self.source),
+                "target": self.target,
+                "refilling": self._in_flight,
+                "refill_per_minute": len(self._recent),
+                "hits": self.hits,
+                "misses": self.misses,
+                "produced": self.produced,
+                "failures": self.failures,
+                "running": bool(self._threads)
+            }
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                # Cards being generated count towards the target
+                while not self._stopping.is_set() and self.pool_store.depth(self.source) + self._in_flight >= self.target:
+                    self._wakeup.wait(self.retry_delay)
+                if self._stopping.is_set():
+                    return
+                self._in_flight += 1
+
+            started = time.monotonic()
+            try:
+                md5 = self.produce()
+            except Exception:
+                traceback.print_exc()
+                md5 = None
+
+            if md5:
+                self.pool_store.add(self.source, md5)
+            with self._lock:
+                self._in_flight -= 1
+                if md5:
+                    self.produced += 1
+                    self._recent.append(time.time())
+                else:
+                    self.failures += 1
+
+            delay = self.interval if md5 else self.retry_delay
+            self._stopping.wait(max(0.0, delay - (time.monotonic() - started)))